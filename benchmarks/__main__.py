@@ -0,0 +1,58 @@
+"""Runs POP3 and SMTP benchmarks against servers on localhost
+
+python -m benchmarks [--output results.json]
+
+Each result is printed as a JSON line. With --output, all results are
+also saved as a JSON list to compare across versions.
+"""
+
+import asyncio
+import json
+import logging
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+
+from . import bench_pop, bench_scan, bench_smtp, bench_tls
+
+
+async def run(args) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory(prefix="m41.bench.") as tmpdir:
+        mails_path = Path(tmpdir)
+        if "pop" in args.only:
+            results += await bench_pop.run_all(
+                mails_path / "pop", args.mails, args.repeat
+            )
+        if "smtp" in args.only:
+            results += await bench_smtp.run_all(mails_path / "smtp", args.fanout)
+    if "tls" in args.only:
+        results += await bench_tls.run_all(connections=200)
+    if "scan" in args.only:
+        results += [bench_scan.run(num_mails, args.repeat) for num_mails in args.mails]
+    return results
+
+
+def main() -> None:
+    parser = ArgumentParser(description="mail4one benchmarks")
+    parser.add_argument("--mails", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--fanout", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        default=["pop", "smtp", "tls", "scan"],
+        choices=["pop", "smtp", "tls", "scan"],
+    )
+    parser.add_argument("--output", type=Path, help="Save results as JSON list")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    results = asyncio.run(run(args))
+    for res in results:
+        print(json.dumps(res))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""POP3 server benchmarks: logins/sec, LIST/UIDL latency and RETR throughput"""
+
+import asyncio
+import time
+from pathlib import Path
+
+from mail4one.config import User
+from mail4one.pop3 import create_pop_server
+from mail4one.pwhash import gen_pwhash
+
+from .utils import latency_ms, result
+
+PASSWORD = "benchpassword"
+MAIL = b"From: a@b.com\r\nSubject: hello\r\n\r\nHello there\r\n.dotted line\r\n"
+
+
+def make_mbox(mails_path: Path, mbox: str, num_mails: int, mail: bytes = MAIL):
+    new_path = mails_path / mbox / "new"
+    new_path.mkdir(parents=True)
+    for i in range(num_mails):
+        (new_path / f"{i:08}.eml").write_bytes(mail)
+
+
+class Client:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port: int) -> "Client":
+        client = cls(*await asyncio.open_connection("127.0.0.1", port))
+        await client.response()
+        return client
+
+    async def response(self) -> bytes:
+        line = await self.reader.readline()
+        if not line.startswith(b"+OK"):
+            raise Exception(f"Unexpected response {line!r}")
+        return line
+
+    async def multiline(self) -> int:
+        """Reads till end of multi-line response, returns bytes read"""
+        total = 0
+        tail = b""
+        while not tail.endswith(b"\r\n.\r\n"):
+            data = await self.reader.read(64 * 1024)
+            if not data:
+                raise Exception("Connection closed")
+            total += len(data)
+            tail = tail[-4:] + data[-5:]
+        return total
+
+    async def cmd(self, command: str) -> bytes:
+        self.writer.write(f"{command}\r\n".encode())
+        return await self.response()
+
+    async def login(self, username: str) -> None:
+        await self.cmd(f"USER {username}")
+        await self.cmd(f"PASS {PASSWORD}")
+
+    async def quit(self) -> None:
+        await self.cmd("QUIT")
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def start_server(mails_path: Path, users: list[User], **kwargs) -> asyncio.Server:
+    server = await create_pop_server(
+        host="127.0.0.1", port=0, mails_path=mails_path, users=users, **kwargs
+    )
+    await server.start_serving()
+    return server
+
+
+def port_of(server: asyncio.Server) -> int:
+    return server.sockets[0].getsockname()[1]
+
+
+async def bench_logins(mails_path: Path, duration: float, cache: bool) -> dict:
+    concurrency = 4
+    pwhash = gen_pwhash(PASSWORD)
+    users = [
+        User(username=f"u{i}", password_hash=pwhash, mbox="logins")
+        for i in range(concurrency)
+    ]
+    make_mbox(mails_path, "logins", 10)
+    server = await start_server(mails_path, users, auth_cache_size=64 if cache else 0)
+    port = port_of(server)
+    count = 0
+    end = time.perf_counter() + duration
+
+    async def worker(username: str):
+        nonlocal count
+        while time.perf_counter() < end:
+            client = await Client.connect(port)
+            await client.login(username)
+            await client.quit()
+            count += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(user.username) for user in users))
+    elapsed = time.perf_counter() - start
+    server.close()
+    return result(
+        "pop_logins",
+        auth_cache=cache,
+        concurrency=concurrency,
+        logins=count,
+        logins_per_sec=count / elapsed,
+    )
+
+
+async def bench_listing(mails_path: Path, num_mails: int, repeat: int) -> list[dict]:
+    mbox = f"listing{num_mails}"
+    make_mbox(mails_path, mbox, num_mails)
+    users = [User(username=mbox, password_hash=gen_pwhash(PASSWORD), mbox=mbox)]
+    server = await start_server(mails_path, users)
+    port = port_of(server)
+    results = []
+
+    async def login():
+        client = await Client.connect(port)
+        await client.login(mbox)
+        await client.quit()
+
+    results.append(
+        result("pop_first_login", mails=num_mails, **await latency_ms(login, 1))
+    )
+    results.append(
+        result("pop_login", mails=num_mails, **await latency_ms(login, repeat))
+    )
+
+    client = await Client.connect(port)
+    await client.login(mbox)
+    for command in ("STAT", "LIST", "UIDL"):
+
+        async def run():
+            await client.cmd(command)
+            if command != "STAT":
+                await client.multiline()
+
+        results.append(
+            result(
+                f"pop_{command.lower()}",
+                mails=num_mails,
+                **await latency_ms(run, repeat),
+            )
+        )
+    await client.quit()
+    server.close()
+    return results
+
+
+async def bench_retr(mails_path: Path, size_mb: int, repeat: int) -> dict:
+    line = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit\r\n"
+    mail = MAIL + line * (size_mb * 1024 * 1024 // len(line))
+    make_mbox(mails_path, "retr", 1, mail)
+    users = [User(username="retr", password_hash=gen_pwhash(PASSWORD), mbox="retr")]
+    server = await start_server(mails_path, users)
+    client = await Client.connect(port_of(server))
+    await client.login("retr")
+
+    async def retr():
+        await client.cmd("RETR 1")
+        await client.multiline()
+        await client.cmd("RSET")
+
+    stats = await latency_ms(retr, repeat)
+    await client.quit()
+    server.close()
+    return result(
+        "pop_retr",
+        size_bytes=len(mail),
+        mb_per_sec=len(mail) / 1024 / 1024 / (stats["median_ms"] / 1000),
+        **stats,
+    )
+
+
+async def run_all(mails_path: Path, mail_counts: list[int], repeat: int) -> list[dict]:
+    results = [
+        await bench_logins(mails_path / "nocache", duration=3, cache=False),
+        await bench_logins(mails_path / "cache", duration=3, cache=True),
+    ]
+    for num_mails in mail_counts:
+        results += await bench_listing(mails_path, num_mails, repeat)
+    results.append(await bench_retr(mails_path, size_mb=20, repeat=repeat))
+    return results
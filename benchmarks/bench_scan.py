@@ -0,0 +1,64 @@
+"""Compares mbox directory scan implementations
+
+python -m benchmarks.bench_scan [--mails 1000 10000 100000]
+"""
+
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from mail4one import poputils
+
+from .utils import result
+
+
+def walk_and_stat(dirpath: Path) -> list[tuple[str, int, float]]:
+    """Scan as done before os.scandir, os.walk and os.stat per file"""
+    for _, _, files in os.walk(dirpath):
+        entries = []
+        for filename in files:
+            stats = os.stat(os.path.join(dirpath, filename))
+            entries.append((filename, stats.st_size, stats.st_ctime))
+        return entries
+    return []
+
+
+def timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(num_mails: int, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="m41.bench.") as tmpdir:
+        path = Path(tmpdir)
+        for i in range(num_mails):
+            (path / f"{i:08}.eml").write_bytes(b"Subject: hi\r\n\r\nhello\r\n")
+        return result(
+            "scan",
+            mails=num_mails,
+            walk_and_stat_s=timeit(lambda: walk_and_stat(path), repeat),
+            scandir_s=timeit(lambda: poputils.get_mails_list(path, 1), repeat),
+            scandir_parallel_s=timeit(
+                lambda: poputils.get_mails_list(path, poputils.SCAN_WORKERS), repeat
+            ),
+        )
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mails", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for num_mails in args.mails:
+        print(json.dumps(run(num_mails, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
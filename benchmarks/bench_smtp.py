@@ -0,0 +1,89 @@
+"""SMTP server benchmarks: messages/sec with fan-out to N mboxes"""
+
+import asyncio
+import time
+from pathlib import Path
+
+from mail4one.smtp import create_smtp_server
+
+from .utils import result
+
+MAIL = (
+    b"From: a@b.com\r\nTo: c@d.com\r\nSubject: hello\r\n\r\n" + b"Hello there\r\n" * 200
+)
+
+
+class Client:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def response(self) -> bytes:
+        while True:
+            line = await self.reader.readline()
+            if not line[:1] in b"23":
+                raise Exception(f"Unexpected response {line!r}")
+            if line[3:4] != b"-":
+                return line
+
+    async def cmd(self, command: bytes) -> bytes:
+        self.writer.write(command + b"\r\n")
+        return await self.response()
+
+    async def send(self, mail: bytes) -> None:
+        await self.cmd(b"MAIL FROM:<a@b.com>")
+        await self.cmd(b"RCPT TO:<c@d.com>")
+        await self.cmd(b"DATA")
+        await self.cmd(mail + b".")
+
+
+async def bench_delivery(
+    mails_path: Path, fanout: int, raw_delivery: bool, duration: float
+) -> dict:
+    concurrency = 4
+    mboxes = [f"fanout{fanout}_{raw_delivery}_{i}" for i in range(fanout)]
+    server = await create_smtp_server(
+        host="127.0.0.1",
+        port=0,
+        mails_path=mails_path,
+        mbox_finder=lambda addr: mboxes,
+        ssl_context=None,
+        smtputf8=True,
+        raw_delivery=raw_delivery,
+    )
+    await server.start_serving()
+    port = server.sockets[0].getsockname()[1]
+    count = 0
+    end = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal count
+        client = Client(*await asyncio.open_connection("127.0.0.1", port))
+        await client.response()
+        await client.cmd(b"EHLO bench")
+        while time.perf_counter() < end:
+            await client.send(MAIL)
+            count += 1
+        await client.cmd(b"QUIT")
+        client.writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    server.close()
+    return result(
+        "smtp_delivery",
+        fanout=fanout,
+        raw_delivery=raw_delivery,
+        concurrency=concurrency,
+        mails=count,
+        mails_per_sec=count / elapsed,
+    )
+
+
+async def run_all(mails_path: Path, fanouts: list[int]) -> list[dict]:
+    return [
+        await bench_delivery(mails_path, fanout, raw_delivery, duration=3)
+        for fanout in fanouts
+        for raw_delivery in (False, True)
+    ]
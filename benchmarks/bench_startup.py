@@ -0,0 +1,149 @@
+"""Startup time of mail4one for each mode, from source or built zipapps
+
+python -m benchmarks.bench_startup [mail4one.pyz ...] [--importtime]
+
+server mode is measured till the POP3 port accepts connections.
+"""
+
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from mail4one.pwhash import gen_pwhash
+
+from .utils import result
+
+PASSWORD = "benchpassword"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def command(target: str) -> list[str]:
+    if target == "source":
+        return [sys.executable, "-m", "mail4one.cli"]
+    return [sys.executable, target]
+
+
+def time_run(cmd: list[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def time_server(cmd: list[str], tmp_path: Path) -> float:
+    port = free_port()
+    config_path = tmp_path / "config.json"
+    cfg = {
+        "mails_path": str(tmp_path / "mails"),
+        "logging": {"logfile": str(tmp_path / "log")},
+        "matches": [],
+        "boxes": [],
+        "users": [
+            {"username": "user", "password_hash": gen_pwhash(PASSWORD), "mbox": "mbox"}
+        ],
+        "servers": [
+            {"server_type": "pop", "host": "127.0.0.1", "port": port, "tls": "disable"}
+        ],
+    }
+    config_path.write_text(json.dumps(cfg))
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd + ["-c", str(config_path)])
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                return time.perf_counter() - start
+            except ConnectionRefusedError:
+                if proc.poll() is not None:
+                    raise Exception(f"Server exited {proc.returncode=}")
+                time.sleep(0.001)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def importtime(target: str, module: str, top: int) -> list[dict]:
+    """Slowest imports by cumulative time"""
+    env = dict(os.environ)
+    if target != "source":
+        env["PYTHONPATH"] = target
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    rows = re.findall(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", proc.stderr)
+    # Only top level imports of the module, nested ones are part of them
+    times = [(int(us), name) for us, indent, name in rows if len(indent) <= 3]
+    times.sort(reverse=True)
+    return [
+        result("importtime", target=target, module=name, cumulative_ms=us / 1000)
+        for us, name in times[:top]
+    ]
+
+
+def run_all(targets: list[str], repeat: int) -> list[dict]:
+    phash = gen_pwhash(PASSWORD)
+    modes = {
+        "version": ["--version"],
+        "pwverify": ["-r", PASSWORD, phash],
+    }
+    results = []
+    with tempfile.TemporaryDirectory(prefix="m41.bench.") as tmpdir:
+        for target in targets:
+            cmd = command(target)
+            for mode, args in modes.items():
+                times = [time_run(cmd + args) for _ in range(repeat)]
+                results.append(
+                    result(
+                        "startup",
+                        target=target,
+                        mode=mode,
+                        median_ms=statistics.median(times) * 1000,
+                    )
+                )
+            times = [time_server(cmd, Path(tmpdir)) for _ in range(repeat)]
+            results.append(
+                result(
+                    "startup",
+                    target=target,
+                    mode="server",
+                    median_ms=statistics.median(times) * 1000,
+                )
+            )
+    return results
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Startup time benchmark")
+    parser.add_argument("targets", nargs="*", default=["source"], help="pyz files")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--importtime", action="store_true", help="Also show slowest imports"
+    )
+    args = parser.parse_args()
+    results = run_all(args.targets, args.repeat)
+    if args.importtime:
+        for target in args.targets:
+            results += importtime(target, "mail4one.cli", top=5)
+            results += importtime(target, "mail4one.server", top=10)
+    for res in results:
+        print(json.dumps(res))
+
+
+if __name__ == "__main__":
+    main()
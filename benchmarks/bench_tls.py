@@ -0,0 +1,102 @@
+"""TLS handshakes/sec of POP3 listeners, full vs resumed sessions
+
+python -m benchmarks.bench_tls [--connections 200]
+
+Needs openssl command to generate a self signed certificate.
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import ssl
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Optional
+
+from mail4one import server
+from tests.certs import make_cert
+
+from .bench_pop import port_of, start_server
+from .utils import result
+
+
+def connect(
+    client_ctx: ssl.SSLContext, port: int, session: Optional[ssl.SSLSession]
+) -> ssl.SSLSocket:
+    sock = socket.create_connection(("127.0.0.1", port))
+    tls_sock = client_ctx.wrap_socket(sock, session=session)
+    # TLS 1.3 tickets arrive after the handshake, with the greeting
+    tls_sock.recv(1024)
+    return tls_sock
+
+
+def handshakes(
+    client_ctx: ssl.SSLContext, ports: list[int], connections: int, resume: bool
+) -> dict:
+    session = None
+    reused = 0
+    start = time.perf_counter()
+    for i in range(connections):
+        tls_sock = connect(client_ctx, ports[i % len(ports)], session)
+        reused += tls_sock.session_reused
+        if resume:
+            session = tls_sock.session
+        tls_sock.sendall(b"QUIT\r\n")
+        tls_sock.recv(1024)
+        tls_sock.close()
+    elapsed = time.perf_counter() - start
+    return {"handshakes_per_sec": connections / elapsed, "reused": reused}
+
+
+async def run_all(connections: int) -> list[dict]:
+    results = []
+    client_ctx = ssl.create_default_context()
+    client_ctx.check_hostname = False
+    client_ctx.verify_mode = ssl.CERT_NONE
+    with tempfile.TemporaryDirectory(prefix="m41.bench.") as tmpdir:
+        tmp_path = Path(tmpdir)
+        certfile, keyfile = make_cert(tmp_path)
+
+        def new_context(**kwargs) -> ssl.SSLContext:
+            server.create_tls_context.cache_clear()
+            return server.create_tls_context(certfile, keyfile, **kwargs)
+
+        # Two listeners, like pop and smtp sharing a certificate
+        cases = [
+            ("full", False, [new_context(), new_context()]),
+            ("resumed", True, [new_context()] * 2),
+            ("resumed_no_tickets", True, [new_context(session_tickets=False)] * 2),
+            # Before contexts were shared, each listener had its own
+            ("resumed_separate_contexts", True, [new_context(), new_context()]),
+        ]
+        for name, resume, contexts in cases:
+            servers = [
+                await start_server(tmp_path / name, [], ssl_context=context)
+                for context in contexts
+            ]
+            ports = [port_of(srv) for srv in servers]
+            stats = await asyncio.to_thread(
+                handshakes, client_ctx, ports, connections, resume
+            )
+            for srv in servers:
+                srv.close()
+            results.append(
+                result("tls_handshake", case=name, connections=connections, **stats)
+            )
+    return results
+
+
+def main() -> None:
+    parser = ArgumentParser(description="TLS handshake benchmark")
+    parser.add_argument("--connections", type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    for res in asyncio.run(run_all(args.connections)):
+        print(json.dumps(res))
+
+
+if __name__ == "__main__":
+    main()
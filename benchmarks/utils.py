@@ -0,0 +1,29 @@
+import platform
+import statistics
+import time
+from typing import Callable
+
+from mail4one.version import VERSION
+
+
+def result(benchmark: str, **values) -> dict:
+    return {
+        "benchmark": benchmark,
+        "version": VERSION,
+        "python": platform.python_version(),
+        **values,
+    }
+
+
+async def latency_ms(fn: Callable, repeat: int) -> dict:
+    """Runs coroutine function fn repeat times, returns latency stats"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "max_ms": max(times),
+    }
@@ -0,0 +1,206 @@
+"""Limits connections and failed logins, shared by all listeners of a process
+
+Connections are checked as soon as they are accepted, before the TLS
+handshake, so rejecting a flood costs no crypto work.
+"""
+
+import asyncio
+import logging
+import ssl
+import time
+from typing import Callable, Optional
+
+from . import metrics
+
+logger = logging.getLogger("admission")
+
+# Idle buckets are dropped when more than these many ips are tracked
+MAX_TRACKED_IPS = 10000
+
+
+class RateLimiter:
+    """Token bucket per key, refills rate tokens per second up to burst"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        # key -> tokens, last updated
+        self.buckets: dict[str, tuple[float, float]] = {}
+
+    def tokens(self, key: str, now: float) -> float:
+        try:
+            tokens, updated = self.buckets[key]
+        except KeyError:
+            return self.burst
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allowed(self, key: str) -> bool:
+        return self.rate <= 0 or self.tokens(key, time.monotonic()) >= 1
+
+    def take(self, key: str) -> bool:
+        """Takes a token if available, always allowed when rate is 0"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens = self.tokens(key, now)
+        if tokens < 1:
+            return False
+        self.buckets[key] = tokens - 1, now
+        if len(self.buckets) > MAX_TRACKED_IPS:
+            self.prune(now)
+        return True
+
+    def prune(self, now: float) -> None:
+        self.buckets = {
+            key: bucket
+            for key, bucket in self.buckets.items()
+            if self.tokens(key, now) < self.burst
+        }
+
+
+class Admission:
+    def __init__(
+        self,
+        max_connections: int,
+        max_connections_per_ip: int,
+        connects_per_minute: float,
+        connect_burst: int,
+        auth_fails_per_minute: float,
+        auth_fail_burst: int,
+    ):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.connects = RateLimiter(connects_per_minute / 60, connect_burst)
+        self.auth_fails = RateLimiter(auth_fails_per_minute / 60, auth_fail_burst)
+        self.total = 0
+        self.active: dict[str, int] = {}
+
+    def admit(self, ip: str) -> Optional[str]:
+        """Returns the reason if the connection should be rejected"""
+        if self.max_connections and self.total >= self.max_connections:
+            return "max_connections"
+        active = self.active.get(ip, 0)
+        if self.max_connections_per_ip and active >= self.max_connections_per_ip:
+            return "max_connections_per_ip"
+        if not self.connects.take(ip):
+            return "connect_rate"
+        self.total += 1
+        self.active[ip] = active + 1
+        return None
+
+    def release(self, ip: str) -> None:
+        self.total -= 1
+        if (active := self.active[ip] - 1) > 0:
+            self.active[ip] = active
+        else:
+            del self.active[ip]
+
+    def auth_allowed(self, ip: str) -> bool:
+        return self.auth_fails.allowed(ip)
+
+    def auth_failed(self, ip: str) -> None:
+        self.auth_fails.take(ip)
+
+
+class Gate(asyncio.Protocol):
+    """Admits a connection, does the TLS handshake if needed, then hands the
+    connection over to the protocol made by protocol_factory"""
+
+    # Running handshakes, the loop only keeps weak references to tasks
+    handshakes: set[asyncio.Task] = set()
+
+    def __init__(
+        self,
+        admission: Admission,
+        protocol_factory: Callable[[], asyncio.BaseProtocol],
+        ssl_context: Optional[ssl.SSLContext],
+    ):
+        self.admission = admission
+        self.protocol_factory = protocol_factory
+        self.ssl_context = ssl_context
+        self.ip = ""
+        self.admitted = False
+        # Received after handshake, before hand over
+        self.pending: list[bytes] = []
+
+    def connection_made(self, transport: asyncio.Transport) -> None:  # type: ignore[override]
+        self.ip = transport.get_extra_info("peername")[0]
+        if reason := self.admission.admit(self.ip):
+            logger.info(f"Rejected connection from {self.ip}, {reason=}")
+            metrics.REJECTED_CONNECTIONS.inc((reason,))
+            transport.abort()
+            return
+        self.admitted = True
+        if self.ssl_context:
+            task = asyncio.ensure_future(self.start_tls(transport))
+            self.handshakes.add(task)
+            task.add_done_callback(self.handshakes.discard)
+        else:
+            self.hand_over(transport)
+
+    async def start_tls(self, transport: asyncio.Transport) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            tls_transport = await loop.start_tls(
+                transport, self, self.ssl_context, server_side=True  # type: ignore
+            )
+        except Exception as e:
+            logger.info(f"TLS handshake failed {self.ip} {e!r}")
+            tls_transport = None
+        if not tls_transport:  # Closed during handshake
+            transport.abort()
+            self.release()
+            return
+        self.hand_over(tls_transport)
+
+    def hand_over(self, transport: asyncio.Transport) -> None:
+        if not self.admitted:  # Lost during handshake
+            return
+        protocol = self.protocol_factory()
+        lost = protocol.connection_lost
+
+        def connection_lost(exc: Optional[Exception]) -> None:
+            self.release()
+            lost(exc)
+
+        # Wraps the protocol's own method instead of proxying, as SMTP
+        # STARTTLS moves the transport to a new SSL protocol
+        protocol.connection_lost = connection_lost  # type: ignore[method-assign]
+        transport.set_protocol(protocol)
+        protocol.connection_made(transport)
+        for data in self.pending:
+            protocol.data_received(data)  # type: ignore[attr-defined]
+        self.pending.clear()
+
+    def release(self) -> None:
+        if self.admitted:
+            self.admitted = False
+            self.admission.release(self.ip)
+
+    def data_received(self, data: bytes) -> None:
+        self.pending.append(data)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.release()
+
+
+async def create_server(
+    protocol_factory: Callable[[], asyncio.BaseProtocol],
+    host: str,
+    port: int,
+    ssl_context: Optional[ssl.SSLContext],
+    admission: Optional[Admission],
+    **kwargs,
+) -> asyncio.Server:
+    """loop.create_server, with admission checked before the TLS handshake"""
+    loop = asyncio.get_running_loop()
+    if not admission:
+        return await loop.create_server(
+            protocol_factory, host=host, port=port, ssl=ssl_context, **kwargs
+        )
+    return await loop.create_server(
+        lambda: Gate(admission, protocol_factory, ssl_context),
+        host=host,
+        port=port,
+        **kwargs,
+    )
@@ -0,0 +1,78 @@
+"""Entry point of mail4one.pyz
+
+Only what the password commands need is imported here, server modules
+(asyncio, aiosmtpd, email, ssl) are imported when running the server.
+Check with: python -X importtime -m mail4one.cli -r foo bar
+"""
+
+import signal
+from argparse import ArgumentParser
+from getpass import getpass
+from pathlib import Path
+
+from .version import VERSION
+
+from . import pwhash
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="Personal Mail Server",
+        epilog="See https://gitea.balki.me/balki/mail4one for more info",
+    )
+    parser.add_argument("-v", "--version", action="version", version=VERSION)
+    parser.add_argument(
+        "-e",
+        "--echo_password",
+        action="store_true",
+        help="Show password in command line if -g without password is used",
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "-c",
+        "--config",
+        metavar="CONFIG_PATH",
+        type=Path,
+        help="Run mail server with passed config",
+    )
+    group.add_argument(
+        "-g",
+        "--genpwhash",
+        nargs="?",
+        dest="password",
+        const="FROM_TERMINAL",
+        metavar="PASSWORD",
+        help="Generate password hash to add in config",
+    )
+    group.add_argument(
+        "-r",
+        "--pwverify",
+        dest="password_pwhash",
+        nargs=2,
+        metavar=("PASSWORD", "PWHASH"),
+        help="Check if password matches password hash",
+    )
+    args = parser.parse_args()
+    if password := args.password:
+        if password == "FROM_TERMINAL":
+            if args.echo_password:
+                password = input("Enter password: ")
+            else:
+                password = getpass("Enter password: ")
+        print(pwhash.gen_pwhash(password))
+    elif args.password_pwhash:
+        password, phash = args.password_pwhash
+        if pwhash.check_pass(password, pwhash.parse_hash(phash)):
+            print("✓ password and hash match")
+        else:
+            print("✗ password and hash do not match")
+    else:
+        # Reload may come while the server modules are being imported
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        from .server import run
+
+        run(args.config)
+
+
+if __name__ == "__main__":
+    main()
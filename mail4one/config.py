@@ -2,9 +2,12 @@
 
 import re
 import logging
+from functools import lru_cache
 from typing import Callable, Union, Optional
 from jata import Jata, MutableDefault
 
+from . import metrics
+
 
 class Match(Jata):
     name: str
@@ -22,9 +25,22 @@ class Rule(Jata):
     stop_check: bool = False
 
 
+class RetentionCfg(Jata):
+    """Mails in new/ and cur/ of the mbox are removed by any of these, 0 disables"""
+
+    # Counted from delivery, the file mtime, which moving the mail to cur/
+    # or removing its copies in other mboxes does not change
+    max_age_days = 0
+    # Oldest mails are removed first to stay within the size
+    max_size_mb = 0
+    # Once retrieved or deleted by every user of the mbox
+    delete_downloaded = False
+
+
 class Mbox(Jata):
     name: str
     rules: list[Rule]
+    retention: Optional[RetentionCfg] = None
 
 
 DEFAULT_NULL_MBOX = "default_null_mbox"
@@ -39,6 +55,14 @@ class User(Jata):
 class TLSCfg(Jata):
     certfile: str
     keyfile: str
+    # OpenSSL cipher list for TLS 1.2, empty for python defaults
+    ciphers = ""
+    # e.g. prime256v1, empty for OpenSSL defaults
+    ecdh_curve = ""
+    # Sent after a TLS 1.3 handshake, clients reconnect with them to resume
+    num_tickets = 2
+    # Stateless resumption (tickets), server side session cache is always used
+    session_tickets = True
 
 
 class ServerCfg(Jata):
@@ -53,6 +77,15 @@ class PopCfg(ServerCfg):
     server_type = "pop"
     port = 995
     timeout_seconds = 60
+    # Password checks (scrypt) run in a thread pool of this size
+    auth_workers = 2
+    # Logins waiting for a free worker, more are rejected
+    auth_queue_size = 32
+    # Skip password check for clients reconnecting with same password
+    auth_cache_seconds = 600
+    auth_cache_size = 64
+    # Move mails to cur/ once every user of the mbox has retrieved or deleted it
+    move_to_cur = False
 
 
 class SmtpStartTLSCfg(ServerCfg):
@@ -60,23 +93,65 @@ class SmtpStartTLSCfg(ServerCfg):
     require_starttls = True
     smtputf8 = True
     port = 25
+    # Threads writing mails to disk
+    delivery_workers = 2
+    # Deliveries waiting for a worker, more will wait before reply to DATA
+    delivery_queue_size = 16
+    # Save mails as received without parsing, trace headers are prepended
+    raw_delivery = False
 
 
 class SmtpCfg(ServerCfg):
     server_type = "smtp"
     smtputf8 = True
     port = 465
+    delivery_workers = 2
+    delivery_queue_size = 16
+    raw_delivery = False
+
+
+class MetricsCfg(ServerCfg):
+    """Serves metrics over plain HTTP at /metrics, tls is not used
+
+    With multiple workers, each serves its own metrics at port + worker index"""
+
+    server_type = "metrics"
+    host = "127.0.0.1"
+    port = 9108
 
 
 class LogCfg(Jata):
     logfile = "CONSOLE"
     level = "INFO"
+    # Write logfile from a separate thread, does not apply to CONSOLE
+    queue = True
+
+
+class AdmissionCfg(Jata):
+    """Limits shared by all servers, 0 disables a limit
+
+    Only applied when the admission section is present in the config
+    """
+
+    max_connections = 512
+    max_connections_per_ip = 16
+    # New connections per ip, bursts up to connect_burst are allowed
+    connects_per_minute = 60
+    connect_burst = 20
+    # Failed logins per ip, more are refused without checking the password
+    auth_fails_per_minute = 6
+    auth_fail_burst = 10
 
 
 class Config(Jata):
     default_tls: Optional[TLSCfg] = None
     default_host: str = "0.0.0.0"
     logging: Optional[LogCfg] = None
+    # Processes serving all the servers, connections are spread by the kernel
+    workers: int = 1
+    admission: Optional[AdmissionCfg] = None
+    # Minutes between runs of retention policies of boxes
+    retention_interval_minutes: int = 60
 
     mails_path: str
     matches: list[Match]
@@ -90,15 +165,33 @@ CheckerFn = Callable[[str], bool]
 Checker = tuple[str, CheckerFn, bool]
 
 
+DEFAULT_RE_FLAGS = re.compile("").flags
+
+
+def is_mergeable(reg: re.Pattern) -> bool:
+    """Backreferences would get renumbered and inline flags (allowed mid
+    pattern before 3.11) would apply to all the merged patterns"""
+    return not reg.groups and reg.flags == DEFAULT_RE_FLAGS and "(?" not in reg.pattern
+
+
+def compile_rexs(addr_rexs: list[str]) -> CheckerFn:
+    compiled_res = [re.compile(reg) for reg in addr_rexs]
+    plain = [reg for reg in compiled_res if is_mergeable(reg)]
+    if len(plain) > 1:
+        merged = re.compile("|".join(f"(?:{reg.pattern})" for reg in plain))
+        compiled_res = [merged] + [reg for reg in compiled_res if reg not in plain]
+    return lambda malias: any(reg.match(malias) for reg in compiled_res)
+
+
 def parse_checkers(cfg: Config) -> list[Checker]:
     def make_match_fn(m: Match):
         if m.addrs and m.addr_rexs:
             raise Exception("Both addrs and addr_rexs is set")
         if m.addrs:
-            return lambda malias: malias in m.addrs
+            addrs = frozenset(m.addrs)
+            return lambda malias: malias in addrs
         if m.addr_rexs:
-            compiled_res = [re.compile(reg) for reg in m.addr_rexs]
-            return lambda malias: any(reg.match(malias) for reg in compiled_res)
+            return compile_rexs(m.addr_rexs)
         raise Exception("Neither addrs nor addr_rexs is set")
 
     matches = {m.name: make_match_fn(Match(m)) for m in cfg.matches or []}
@@ -131,7 +224,31 @@ def get_mboxes(addr: str, checks: list[Checker]) -> list[str]:
     return list(inner())
 
 
+# Results for recently seen addresses
+ADDR_CACHE_SIZE = 4096
+
+
 def gen_addr_to_mboxes(cfg: Config) -> Callable[[str], list[str]]:
     checks = parse_checkers(cfg)
     logging.info(f"Parsed checkers from config, {len(checks)=}")
-    return lambda addr: get_mboxes(addr, checks)
+
+    @lru_cache(maxsize=ADDR_CACHE_SIZE)
+    def cached_mboxes(addr: str) -> tuple[str, ...]:
+        return tuple(get_mboxes(addr, checks))
+
+    def addr_to_mboxes(addr: str) -> list[str]:
+        mboxes = cached_mboxes(addr)
+        metrics.ROUTED_ADDRS.inc(("matched",) if mboxes else ("unmatched",))
+        return list(mboxes)
+
+    return addr_to_mboxes
+
+
+class MboxFinder:
+    """Routes with the rules of the current config, replaced on reload"""
+
+    def __init__(self, cfg: Config):
+        self.find = gen_addr_to_mboxes(cfg)
+
+    def __call__(self, addr: str) -> list[str]:
+        return self.find(addr)
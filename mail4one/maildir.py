@@ -0,0 +1,336 @@
+"""Persistent per mbox index of mails in <mails_path>/<mbox>/new
+
+The index lives at <mails_path>/<mbox>/.m41index and has one line per mail,
+"<uid>\\t<size>\\t<ctime>", followed by a stamp line "#\\t<mtime_ns>" with the
+mtime of the new/ directory the index is in sync with. SMTP appends to it on
+delivery and POP3 reads only the newly appended lines. If the stamp does not
+match the directory mtime (e.g. a mail was added or removed by something
+else), the directory is rescanned and the index is rewritten.
+
+Mails moved to cur/ or removed by retention are taken out of new/ under the
+same lock and the index is rewritten, so it stays in sync without a rescan.
+"""
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+from .poputils import MailEntry, get_mails_list
+
+logger = logging.getLogger("maildir")
+
+# Starts with a dot so it can't clash with per user deleted items file
+INDEX_NAME = ".m41index"
+STAMP = "#"
+NO_STAMP = -1
+
+# mtime is updated with the kernel's coarse clock. A mail added right after
+# the scan may not change mtime, so don't trust scans of recently changed dirs
+RACY_NS = 2 * 10**9
+
+
+@contextlib.contextmanager
+def index_lock(mbox_path: Path) -> Iterator[None]:
+    """Serializes changes to new/ and its index across threads and processes"""
+    fd = os.open(mbox_path / "new", os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def format_entry(uid: str, size: int, c_time: float) -> str:
+    return f"{uid}\t{size}\t{c_time!r}\n"
+
+
+def format_stamp(mtime_ns: int) -> str:
+    return f"{STAMP}\t{mtime_ns}\n"
+
+
+def last_stamp(index_path: Path) -> int:
+    try:
+        with open(index_path, "rb") as fp:
+            fp.seek(0, os.SEEK_END)
+            fp.seek(max(0, fp.tell() - 64))
+            last_line = fp.read().splitlines()[-1].decode()
+    except (FileNotFoundError, IndexError):
+        return NO_STAMP
+    kind, _, value = last_line.partition("\t")
+    return int(value) if kind == STAMP else NO_STAMP
+
+
+def write_index(
+    index_path: Path, entries: Iterable[tuple[str, int, float]], stamp: int
+) -> os.stat_result:
+    """Replaces the index atomically, returns stats of the new file"""
+    tmp_path = index_path.with_name(f"{INDEX_NAME}.tmp")
+    with open(tmp_path, "w") as fp:
+        fp.writelines(format_entry(*entry) for entry in entries)
+        if stamp != NO_STAMP:
+            fp.write(format_stamp(stamp))
+    os.replace(tmp_path, index_path)
+    return os.stat(index_path)
+
+
+def add_mail(mbox_path: Path, filename: str, add: Callable[[Path], None]) -> None:
+    """Calls add(<path in new/>) to create the mail and records it in the index
+
+    The stamp is updated only if the index was in sync before the mail was
+    added, otherwise the index is left stale for the reader to rebuild"""
+    new_path = mbox_path / "new"
+    index_path = mbox_path / INDEX_NAME
+    with index_lock(mbox_path):
+        before = os.stat(new_path).st_mtime_ns
+        add(new_path / filename)
+        stats = os.stat(new_path / filename)
+        after = os.stat(new_path).st_mtime_ns
+        lines = format_entry(filename, stats.st_size, stats.st_ctime)
+        if last_stamp(index_path) == before:
+            lines += format_stamp(after)
+        with open(index_path, "a") as fp:
+            fp.write(lines)
+
+
+def is_indexable(uid: str) -> bool:
+    return uid != STAMP and "\t" not in uid and "\n" not in uid
+
+
+class MailIndex:
+    """Cached view of an mbox index, reads only what was appended since last load"""
+
+    def __init__(self, mbox_path: Path):
+        self.mbox_path = mbox_path
+        self.new_path = mbox_path / "new"
+        self.index_path = mbox_path / INDEX_NAME
+        self.reset()
+        # Last loaded list, shared by sessions till new/ or index changes
+        self.snapshot: list[MailEntry] = []
+        self.snapshot_key: Optional[tuple[int, int, int]] = None
+
+    def reset(self) -> None:
+        self.entries: dict[str, tuple[int, float]] = {}
+        self.stamp = NO_STAMP
+        self.offset = 0
+        self.inode = 0
+
+    def read_appended(self) -> None:
+        try:
+            fp = open(self.index_path, "rb")
+        except FileNotFoundError:
+            self.reset()
+            return
+        with fp:
+            stats = os.fstat(fp.fileno())
+            if stats.st_ino != self.inode or stats.st_size < self.offset:
+                self.reset()
+                self.inode = stats.st_ino
+            fp.seek(self.offset)
+            data = fp.read()
+        # Ignore partially written last line, will be read next time
+        data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        try:
+            for line in data.decode().splitlines():
+                uid, *values = line.split("\t")
+                if uid == STAMP:
+                    (stamp,) = values
+                    self.stamp = int(stamp)
+                else:
+                    size, c_time = values
+                    self.entries[uid] = int(size), float(c_time)
+                    self.stamp = NO_STAMP
+        except ValueError:
+            logger.warning(f"Corrupt index {self.index_path}, will be rebuilt")
+            self.reset()
+
+    def rebuild(self) -> list[MailEntry]:
+        with index_lock(self.mbox_path):
+            mtime = os.stat(self.new_path).st_mtime_ns
+            mails = get_mails_list(self.new_path)
+            indexed = [entry for entry in mails if is_indexable(entry.uid)]
+            stamp = mtime
+            if time.time_ns() - mtime < RACY_NS:
+                stamp = NO_STAMP
+            if len(indexed) != len(mails):
+                logger.warning(f"Odd file names in {self.new_path}, not indexing")
+                stamp = NO_STAMP
+            stats = write_index(
+                self.index_path,
+                ((entry.uid, entry.size, entry.c_time) for entry in indexed),
+                stamp,
+            )
+        logger.info(f"Rebuilt index of {self.new_path}, {len(mails)=}")
+        self.entries = {entry.uid: (entry.size, entry.c_time) for entry in indexed}
+        self.stamp = stamp
+        self.offset = stats.st_size
+        self.inode = stats.st_ino
+        return mails
+
+    def current_key(self) -> Optional[tuple[int, int, int]]:
+        """Changes when a mail is added or removed from new/ or index is updated"""
+        try:
+            mtime = os.stat(self.new_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        try:
+            stats = os.stat(self.index_path)
+        except FileNotFoundError:
+            return mtime, 0, 0
+        return mtime, stats.st_ino, stats.st_size
+
+    def load(self) -> list[MailEntry]:
+        """Returned list is shared, callers should not modify it"""
+        key = self.current_key()
+        if key is None:
+            return []
+        if key == self.snapshot_key:
+            return self.snapshot
+        mtime, _, _ = key
+        self.read_appended()
+        if self.stamp != mtime:
+            mails = self.rebuild()
+            # State of new/ and index as seen by rebuild under the lock
+            key = self.stamp, self.inode, self.offset
+        else:
+            new_path = str(self.new_path)
+            mails = [
+                MailEntry(uid, size, c_time, new_path)
+                for uid, (size, c_time) in self.entries.items()
+            ]
+        # Untrusted scans (see RACY_NS) are not reused
+        self.snapshot_key = None if self.stamp == NO_STAMP else key
+        self.snapshot = mails
+        return mails
+
+
+def take_out(
+    mbox_path: Path, uids: Iterable[str], action: Callable[[Path], None]
+) -> set[str]:
+    """Calls action(<path in new/>) to move or remove each mail, returns uids
+    taken out. The index is rewritten without them if it was in sync, so
+    readers don't have to rescan new/"""
+    new_path = mbox_path / "new"
+    with index_lock(mbox_path):
+        before = os.stat(new_path).st_mtime_ns
+        index = MailIndex(mbox_path)
+        index.read_appended()
+        taken = set()
+        for uid in uids:
+            try:
+                action(new_path / uid)
+            except FileNotFoundError:  # Taken out by another session
+                continue
+            taken.add(uid)
+        if taken and index.stamp == before:
+            write_index(
+                index.index_path,
+                (
+                    (uid, size, c_time)
+                    for uid, (size, c_time) in index.entries.items()
+                    if uid not in taken
+                ),
+                os.stat(new_path).st_mtime_ns,
+            )
+    return taken
+
+
+def get_deleted_items(deleted_items_path: Path) -> set[str]:
+    """Uids of mails a user deleted, saved by POP3 at <mbox>/<username>"""
+    if deleted_items_path.exists():
+        with deleted_items_path.open() as f:
+            lines = f.read().split("\n")
+        # Last item is either empty or partially written
+        return set(lines[:-1])
+    return set()
+
+
+def done_by_all(mbox_path: Path, usernames: list[str], uids: set[str]) -> set[str]:
+    """Mails deleted (or retrieved) by every user of the mbox"""
+    done = set(uids)
+    for username in usernames:
+        if not done:
+            break
+        done &= get_deleted_items(mbox_path / username)
+    return done
+
+
+def move_to_cur(mbox_path: Path, uids: set[str]) -> int:
+    """Moves mails from new/ to cur/ marked as seen, returns count moved"""
+    cur_path = mbox_path / "cur"
+    cur_path.mkdir(mode=0o755, exist_ok=True)
+
+    def move(path: Path) -> None:
+        os.rename(path, cur_path / f"{path.name}:2,S")
+
+    return len(take_out(mbox_path, uids, move))
+
+
+def remove_mails(mbox_path: Path, uids: Iterable[str]) -> set[str]:
+    return take_out(mbox_path, uids, os.unlink)
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        # e.g. mbox is on a different filesystem
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(src, dst)
+
+
+class Maildirs:
+    """Delivers mails to mboxes under mails_path"""
+
+    def __init__(self, mails_path: Path):
+        self.mails_path = mails_path
+        # mboxes whose new, tmp, cur dirs are known to exist
+        self.created: set[str] = set()
+
+    def ensure_mbox(self, mbox: str) -> Path:
+        mbox_path = self.mails_path / mbox
+        if mbox not in self.created:
+            for sub in ("new", "tmp", "cur"):
+                sub_path = mbox_path / sub
+                sub_path.mkdir(mode=0o755, exist_ok=True, parents=True)
+            self.created.add(mbox)
+        return mbox_path
+
+    def in_mbox(self, mbox: str, action: Callable[[Path], None]) -> None:
+        """Calls action(<mbox path>), creating the mbox again if it was
+        removed from outside"""
+        try:
+            action(self.ensure_mbox(mbox))
+        except FileNotFoundError:
+            self.created.discard(mbox)
+            action(self.ensure_mbox(mbox))
+
+    def deliver(self, mboxes: list[str], write: Callable[[BinaryIO], None]) -> str:
+        """Calls write once to save the mail in tmp/ of first mbox and links it
+        to new/ of all the mboxes. Returns the file name used"""
+        filename = f"{uuid.uuid4()}.eml"
+        tmp_path = self.mails_path / mboxes[0] / "tmp" / filename
+
+        def write_tmp(mbox_path: Path) -> None:
+            with open(tmp_path, "wb") as fp:
+                write(fp)
+
+        def link(mbox_path: Path) -> None:
+            add_mail(mbox_path, filename, lambda dst: link_or_copy(tmp_path, dst))
+
+        self.in_mbox(mboxes[0], write_tmp)
+        try:
+            # Retried per mbox, so mboxes already linked don't get it twice
+            for mbox in mboxes:
+                self.in_mbox(mbox, link)
+        finally:
+            tmp_path.unlink()
+        return filename
@@ -0,0 +1,204 @@
+"""In process metrics, served in Prometheus text format when configured
+
+Metrics are plain counters updated from the event loop, nothing is computed
+till scraped. Threads only update metrics through the loop.
+"""
+
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Iterator
+
+logger = logging.getLogger("metrics")
+
+# Seconds, covers fast commands to slow scrypt checks and large RETRs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Scrapers send the request right away, idle connections are closed after this
+REQUEST_TIMEOUT_SECONDS = 10
+
+Labels = tuple[str, ...]
+
+
+def format_labels(names: Labels, values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+class Metric:
+    kind = ""
+    # Defined by each kind of metric
+    samples: Callable[[], Iterator[str]]
+
+    def __init__(self, name: str, doc: str, labelnames: Labels = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labelnames: Labels = ()):
+        super().__init__(name, doc, labelnames)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels: Labels = ()) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: Labels = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+    def set(self, labels: Labels = (), value: float = 0) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, doc, labelnames)
+        self.buckets = buckets
+        # Per labels: count in each bucket (last is +Inf), sum
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        try:
+            counts, total = self.values[labels]
+        except KeyError:
+            counts, total = self.values[labels] = [0] * (len(self.buckets) + 1), [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        return sum(self.values[labels][0]) if labels in self.values else 0
+
+    def samples(self) -> Iterator[str]:
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{format_labels(names, labels + (le,))} {cumulative}"
+            label_str = format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {total[0]}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+REGISTRY: list[Metric] = []
+
+POP_SESSIONS = Counter("mail4one_pop_sessions_total", "POP3 connections accepted")
+POP_ACTIVE_SESSIONS = Gauge("mail4one_pop_active_sessions", "Open POP3 connections")
+POP_COMMAND_SECONDS = Histogram(
+    "mail4one_pop_command_seconds",
+    "Time to handle POP3 commands after login",
+    ("command",),
+)
+POP_BYTES_SENT = Counter("mail4one_pop_sent_bytes_total", "Bytes written to clients")
+POP_AUTH_SECONDS = Histogram(
+    "mail4one_pop_auth_seconds",
+    "Time to check passwords, including wait for a worker",
+    ("result",),
+)
+POP_MOVED_MAILS = Counter(
+    "mail4one_pop_moved_mails_total", "Mails moved to cur/ after all users got them"
+)
+SMTP_DELIVERY_SECONDS = Histogram(
+    "mail4one_smtp_delivery_seconds",
+    "Time to save mails, including wait for a worker",
+    ("result",),
+)
+SMTP_DELIVERY_PENDING = Gauge(
+    "mail4one_smtp_delivery_pending", "Deliveries waiting or being written"
+)
+SMTP_RECEIVED_BYTES = Counter(
+    "mail4one_smtp_received_bytes_total",
+    "Size of mails received, including ones dropped or failed to save",
+)
+REJECTED_CONNECTIONS = Counter(
+    "mail4one_rejected_connections_total",
+    "Connections closed by admission control",
+    ("reason",),
+)
+REJECTED_LOGINS = Counter(
+    "mail4one_rejected_logins_total", "Logins refused after too many failures"
+)
+RETENTION_REMOVED_MAILS = Counter(
+    "mail4one_retention_removed_mails_total", "Mails removed by retention", ("reason",)
+)
+RETENTION_RECLAIMED_BYTES = Counter(
+    "mail4one_retention_reclaimed_bytes_total",
+    "Size of mails removed by retention, copies linked in other mboxes hold on to it",
+    ("reason",),
+)
+ROUTED_ADDRS = Counter(
+    "mail4one_routed_addrs_total", "Recipient addresses routed", ("result",)
+)
+
+
+def render() -> bytes:
+    lines = [line for metric in REGISTRY for line in metric.render()]
+    return ("\n".join(lines) + "\n").encode()
+
+
+async def read_request(reader: asyncio.StreamReader) -> bytes:
+    request_line = await reader.readline()
+    # Skip headers
+    while (await reader.readline()).strip():
+        pass
+    return request_line
+
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(
+            read_request(reader), REQUEST_TIMEOUT_SECONDS
+        )
+        _, path, *_ = request_line.decode(errors="replace").split() + ["", ""]
+        if path in ("/metrics", "/"):
+            status, body = "200 OK", render()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+        logger.info(f"Metrics client error {e!r}")
+    finally:
+        writer.close()
+
+
+async def create_metrics_server(host: str, port: int) -> asyncio.Server:
+    logging.info(f"Starting metrics server {host=}, {port=}")
+    return await asyncio.start_server(
+        handle_request, host=host, port=port, start_serving=False
+    )
@@ -1,15 +1,21 @@
 import asyncio
-import contextlib
 import contextvars
+import fcntl
 import logging
+import os
 import ssl
 import random
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional, Union
 from asyncio import StreamReader, StreamWriter
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from .config import User
-from .pwhash import parse_hash, check_pass, PWInfo
+from .pwhash import parse_hash, check_pass, PWInfo, VerifiedCache
+from .maildir import MailIndex, done_by_all, get_deleted_items, move_to_cur
+from .admission import Admission, create_server
+from . import metrics
 
 
 from .poputils import (
@@ -24,13 +30,29 @@ from .poputils import (
     ok,
     msg,
     end,
+    END,
     Request,
     MailEntry,
     get_mail_fp,
-    get_mails_list,
     MailList,
+    dot_stuff,
 )
 
+# Large enough to amortize syscalls, small enough to not hold big mails in memory
+RETR_CHUNK_SIZE = 64 * 1024
+# Pipelined responses are sent once they add up to this much
+FLUSH_SIZE = 64 * 1024
+
+# Preallocated frequent responses
+OK_MAILS_FOLLOW = ok("Mails follow")
+OK_DELETED = ok("Deleted")
+OK_CONTENTS_FOLLOW = ok("Contents follow")
+ERR_NOT_FOUND = err("Not found")
+
+READ_SIZE = 4096
+# RFC 2449 limits commands to 255 octets
+MAX_LINE = 1024
+
 
 @dataclass
 class State:
@@ -40,15 +62,97 @@ class State:
     req_id: int
     username: str = ""
     mbox: str = ""
+    # Received but not yet processed
+    inbuf: bytearray = field(default_factory=bytearray)
+    # Responses not yet written to writer
+    out: list[bytes] = field(default_factory=list)
+    out_size: int = 0
+    # Prepended to every log message of the session
+    log_prefix: str = field(init=False, default="")
+
+    def __post_init__(self):
+        self.set_user("", "")
+
+    def set_user(self, username: str, mbox: str) -> None:
+        self.username = username
+        self.mbox = mbox
+        self.log_prefix = f"{self.ip} {self.req_id} {username or 'NA'}"
 
 
 class SharedState:
-    def __init__(self, mails_path: Path, users: dict[str, tuple[PWInfo, str]]):
+    def __init__(
+        self,
+        mails_path: Path,
+        users: "Users",
+        auth_workers: int,
+        auth_queue_size: int,
+        auth_cache_seconds: int,
+        auth_cache_size: int,
+        admission: Optional[Admission] = None,
+        move_to_cur: bool = False,
+    ):
         self.mails_path = mails_path
+        self.admission = admission
+        self.move_to_cur = move_to_cur
         self.users = users
-        self.loggedin_users: set[str] = set()
+        # scrypt releases the GIL, so threads are enough to keep the loop free
+        self.auth_pool = ThreadPoolExecutor(
+            max_workers=auth_workers, thread_name_prefix="pop3_auth"
+        )
+        self.auth_limit = auth_workers + auth_queue_size
+        self.auth_pending = 0
+        self.auth_cache = VerifiedCache(auth_cache_seconds, auth_cache_size)
+        # Logged in username -> fd of its session lock file
+        self.loggedin_users: dict[str, int] = {}
+        self.mail_indexes: dict[str, MailIndex] = {}
+        self.mail_index_locks: dict[str, asyncio.Lock] = {}
         self.counter = random.randint(10000, 99999) * 100000
 
+    async def load_mails(self, mbox: str) -> list[MailEntry]:
+        """Sessions of the same mbox share the scan and the returned list"""
+        if mbox not in self.mail_indexes:
+            self.mail_indexes[mbox] = MailIndex(self.mails_path / mbox)
+            self.mail_index_locks[mbox] = asyncio.Lock()
+        async with self.mail_index_locks[mbox]:
+            return await asyncio.to_thread(self.mail_indexes[mbox].load)
+
+    async def check_pass(self, username: str, password: str, pwinfo: PWInfo) -> bool:
+        if self.auth_cache.check(username, password, pwinfo):
+            return True
+        if self.auth_pending >= self.auth_limit:
+            logger.warning(f"Too many pending logins, {self.auth_pending=}")
+            raise AuthError("Server busy")
+        self.auth_pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            matched = await loop.run_in_executor(
+                self.auth_pool, check_pass, password, pwinfo
+            )
+        finally:
+            self.auth_pending -= 1
+        if matched:
+            self.auth_cache.add(username, password, pwinfo)
+        return matched
+
+    def lock_session(self, username: str, mbox: str) -> bool:
+        """Allows one session per user, also across worker processes"""
+        if username in self.loggedin_users:
+            return False
+        mbox_path = self.mails_path / mbox
+        mbox_path.mkdir(parents=True, exist_ok=True)
+        fd = os.open(mbox_path / f".{username}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.loggedin_users[username] = fd
+        return True
+
+    def unlock_session(self, username: str) -> None:
+        if (fd := self.loggedin_users.pop(username, None)) is not None:
+            os.close(fd)
+
     def next_id(self) -> int:
         self.counter = self.counter + 1
         return self.counter
@@ -73,26 +177,37 @@ class PopLogger(logging.LoggerAdapter):
         super().__init__(logging.getLogger("pop3"), None)
 
     def process(self, log_msg, kwargs):
-        st: State = c_state.get(None)
+        st: Optional[State] = c_state.get(None)
         if not st:
-            return super().process(log_msg, kwargs)
-        user = "NA"
-        if st.username:
-            user = st.username
-        return super().process(f"{st.ip} {st.req_id} {user} {log_msg}", kwargs)
+            return log_msg, kwargs
+        return f"{st.log_prefix} {log_msg}", kwargs
 
 
 logger = PopLogger()
 
 
+async def next_line() -> bytes:
+    st = state()
+    while (eol := st.inbuf.find(b"\n")) < 0:
+        if len(st.inbuf) > MAX_LINE:
+            raise ClientError("Line too long")
+        # All pipelined commands are handled, send responses before waiting
+        await flush()
+        data = await st.reader.read(READ_SIZE)
+        if not data:
+            raise ClientDisconnected
+        st.inbuf += data
+    line = bytes(st.inbuf[: eol + 1])
+    del st.inbuf[: eol + 1]
+    return line
+
+
 async def next_req() -> Request:
     for _ in range(InvalidCommand.RETRIES):
-        line = await state().reader.readline()
-        logger.debug(f"Client: {line!r}")
-        if not line:
-            if state().reader.at_eof():
-                raise ClientDisconnected
-            continue
+        line = await next_line()
+        # Avoid formatting every line when debug logs are disabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Client: {line!r}")
         try:
             request: Request = parse_command(line)
         except InvalidCommand:
@@ -113,20 +228,54 @@ async def expect_cmd(*commands: Command) -> Request:
 
 
 def write(data: bytes) -> None:
-    logger.debug(f"Server: {data!r}")
-    state().writer.write(data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Server: {data!r}")
+    st = state()
+    st.out.append(data)
+    st.out_size += len(data)
 
 
-def validate_password(username, password) -> None:
+def flush_nowait() -> None:
+    st = state()
+    if st.out:
+        data = b"".join(st.out)
+        st.writer.write(data)
+        st.out.clear()
+        st.out_size = 0
+        metrics.POP_BYTES_SENT.inc(amount=len(data))
+
+
+async def flush() -> None:
+    """Sends all pending responses in one write"""
+    flush_nowait()
+    await state().writer.drain()
+
+
+def login_failed() -> None:
+    if admission := scfg().admission:
+        admission.auth_failed(state().ip)
+
+
+async def validate_password(username, password) -> None:
+    admission = scfg().admission
+    if admission and not admission.auth_allowed(state().ip):
+        metrics.REJECTED_LOGINS.inc()
+        raise AuthError("Too many failed logins, try later")
     try:
         pwinfo, mbox = scfg().users[username]
     except:
+        login_failed()
         raise AuthError("Invalid user pass")
 
-    if not check_pass(password, pwinfo):
+    start = time.perf_counter()
+    matched = await scfg().check_pass(username, password, pwinfo)
+    metrics.POP_AUTH_SECONDS.observe(
+        time.perf_counter() - start, ("ok",) if matched else ("fail",)
+    )
+    if not matched:
+        login_failed()
         raise AuthError("Invalid user pass")
-    state().username = username
-    state().mbox = mbox
+    state().set_user(username, mbox)
 
 
 async def handle_user_pass_auth(user_cmd) -> None:
@@ -136,7 +285,7 @@ async def handle_user_pass_auth(user_cmd) -> None:
     write(ok("Welcome"))
     cmd = await expect_cmd(Command.PASS)
     password = cmd.arg1
-    validate_password(username, password)
+    await validate_password(username, password)
     logger.info(f"{username=} has logged in successfully")
 
 
@@ -148,15 +297,17 @@ async def auth_stage() -> None:
             if req.cmd is Command.CAPA:
                 write(ok("Following are supported"))
                 write(msg("USER"))
+                write(msg("PIPELINING"))
                 write(end())
                 continue
             await handle_user_pass_auth(req)
-            if state().username in scfg().loggedin_users:
+            if not scfg().lock_session(state().username, state().mbox):
                 logger.warning(
                     f"User: {state().username} already has an active session"
                 )
+                # Not logged in, so the other session's lock is kept
+                state().set_user("", "")
                 raise AuthError("Already logged in")
-            scfg().loggedin_users.add(state().username)
             write(ok("Login successful"))
             return
         except AuthError as ae:
@@ -171,6 +322,7 @@ async def auth_stage() -> None:
 def trans_command_capa(_, __) -> None:
     write(ok("CAPA follows"))
     write(msg("UIDL"))
+    write(msg("PIPELINING"))
     write(end())
 
 
@@ -185,12 +337,10 @@ def trans_command_list(mails: MailList, req: Request) -> None:
         if entry:
             write(ok(f"{req.arg1} {entry.size}"))
         else:
-            write(err("Not found"))
+            write(ERR_NOT_FOUND)
     else:
-        write(ok("Mails follow"))
-        for entry in mails.get_all():
-            write(msg(f"{entry.nid} {entry.size}"))
-        write(end())
+        listing = "".join(f"{nid} {entry.size}\r\n" for nid, entry in mails.get_all())
+        write(b"".join((OK_MAILS_FOLLOW, listing.encode(), END)))
 
 
 def trans_command_uidl(mails: MailList, req: Request) -> None:
@@ -199,50 +349,67 @@ def trans_command_uidl(mails: MailList, req: Request) -> None:
         if entry:
             write(ok(f"{req.arg1} {entry.uid}"))
         else:
-            write(err("Not found"))
+            write(ERR_NOT_FOUND)
     else:
-        write(ok("Mails follow"))
-        for entry in mails.get_all():
-            write(msg(f"{entry.nid} {entry.uid}"))
-        write(end())
+        listing = "".join(f"{nid} {entry.uid}\r\n" for nid, entry in mails.get_all())
+        write(b"".join((OK_MAILS_FOLLOW, listing.encode(), END)))
 
 
-def trans_command_retr(mails: MailList, req: Request) -> None:
+async def trans_command_retr(mails: MailList, req: Request) -> None:
     entry = mails.get(req.arg1)
     if entry:
-        write(ok("Contents follow"))
-        with get_mail_fp(entry) as fp:
-            for line in fp:
-                if line.startswith(b"."):
-                    write(b".")  # prepend dot
-                write(line)
-        # write(get_mail(entry)) # no prepend dot
-        write(end())
+        try:
+            fp = get_mail_fp(entry)
+        except FileNotFoundError:  # Removed by retention after listing
+            write(ERR_NOT_FOUND)
+            return
+        write(OK_CONTENTS_FOLLOW)
+        out = state().out
+        at_line_start = True
+        size = 0
+        with fp:
+            while chunk := fp.read(RETR_CHUNK_SIZE):
+                out.append(dot_stuff(chunk, at_line_start))
+                at_line_start = chunk.endswith(b"\n")
+                size += len(chunk)
+                await flush()
+        if not at_line_start:
+            out.append(b"\r\n")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Server: <{size} bytes of {entry.uid}>")
+        write(END)
         mails.delete(req.arg1)
     else:
-        write(err("Not found"))
+        write(ERR_NOT_FOUND)
 
 
 def trans_command_dele(mails: MailList, req: Request) -> None:
     entry = mails.get(req.arg1)
     if entry:
         mails.delete(req.arg1)
-        write(ok("Deleted"))
+        write(OK_DELETED)
     else:
-        write(err("Not found"))
+        write(ERR_NOT_FOUND)
+
+
+def trans_command_rset(mails: MailList, _) -> None:
+    mails.reset()
+    write(ok("Reset"))
 
 
 def trans_command_noop(_, __) -> None:
     write(ok("Hmm"))
 
 
+def is_multiline(req: Request) -> bool:
+    if req.cmd in (Command.LIST, Command.UIDL):
+        return not req.arg1
+    return req.cmd is Command.RETR
+
+
 async def process_transactions(mails_list: list[MailEntry]) -> set[str]:
     mails = MailList(mails_list)
 
-    def reset(_, __):
-        nonlocal mails
-        mails = MailList(mails_list)
-
     handle_map = {
         Command.CAPA: trans_command_capa,
         Command.STAT: trans_command_stat,
@@ -250,7 +417,7 @@ async def process_transactions(mails_list: list[MailEntry]) -> set[str]:
         Command.UIDL: trans_command_uidl,
         Command.RETR: trans_command_retr,
         Command.DELE: trans_command_dele,
-        Command.RSET: reset,
+        Command.RSET: trans_command_rset,
         Command.NOOP: trans_command_noop,
     }
 
@@ -260,45 +427,109 @@ async def process_transactions(mails_list: list[MailEntry]) -> set[str]:
         except ClientQuit:
             write(ok("Bye"))
             return mails.deleted_uids
-        logger.debug(f"Request: {req}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Request: {req}")
         try:
             func = handle_map[req.cmd]
         except KeyError:
             write(err("Not implemented"))
             raise ClientError("We shouldn't reach here")
-        func(mails, req)
-        await state().writer.drain()
+        start = time.perf_counter()
+        if asyncio.iscoroutine(result := func(mails, req)):
+            await result
+        metrics.POP_COMMAND_SECONDS.observe(
+            time.perf_counter() - start, (req.cmd.name,)
+        )
+        # Bounds memory used by pipelined commands and keeps back-pressure
+        if state().out_size >= FLUSH_SIZE or is_multiline(req):
+            await flush()
+
+
+# Compact deleted items file when it has at least these many lines and more
+# than half of them are for mails no longer in the mbox
+COMPACT_MIN_ITEMS = 128
+
 
+def is_torn(f: BinaryIO) -> bool:
+    """Last line was partially written, e.g. by a crash"""
+    if f.seek(0, os.SEEK_END) == 0:
+        return False
+    f.seek(-1, os.SEEK_END)
+    return f.read(1) != b"\n"
 
-def get_deleted_items(deleted_items_path: Path) -> set[str]:
-    if deleted_items_path.exists():
-        with deleted_items_path.open() as f:
-            return set(f.read().splitlines())
-    return set()
+
+def append_deleted_items(deleted_items_path: Path, deleted_items: set[str]) -> None:
+    lines = "".join(f"{did}\n" for did in deleted_items).encode()
+    with deleted_items_path.open(mode="ab+") as f:
+        # Torn line is ended and left as an unknown uid instead of extended
+        if is_torn(f):
+            lines = b"\n" + lines
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
 
 
 def save_deleted_items(deleted_items_path: Path, deleted_items: set[str]) -> None:
-    with deleted_items_path.open(mode="w") as f:
+    """Replaces the file atomically, a crash will leave either old or new file"""
+    tmp_path = deleted_items_path.with_name(f".{deleted_items_path.name}.tmp")
+    with tmp_path.open(mode="w") as f:
         f.writelines(f"{did}\n" for did in deleted_items)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, deleted_items_path)
+
+
+def compact_deleted_items(
+    deleted_items_path: Path, deleted_items: set[str], uids: set[str]
+) -> set[str]:
+    """Drops items of mails that are not in the mbox anymore"""
+    live_items = deleted_items & uids
+    if len(deleted_items) >= COMPACT_MIN_ITEMS and len(live_items) * 2 < len(
+        deleted_items
+    ):
+        save_deleted_items(deleted_items_path, live_items)
+        logger.info(f"Compacted deleted items {len(deleted_items)=} {len(live_items)=}")
+        return live_items
+    return deleted_items
 
 
 async def transaction_stage() -> None:
     deleted_items_path = scfg().mails_path / state().mbox / state().username
-    existing_deleted_items: set[str] = get_deleted_items(deleted_items_path)
+    all_mails = await scfg().load_mails(state().mbox)
+    # File IO, fsync in particular, kept off the event loop
+    existing_deleted_items = await asyncio.to_thread(
+        compact_deleted_items,
+        deleted_items_path,
+        await asyncio.to_thread(get_deleted_items, deleted_items_path),
+        {entry.uid for entry in all_mails},
+    )
     mails_list = [
-        entry
-        for entry in get_mails_list(scfg().mails_path / state().mbox / "new")
-        if entry.uid not in existing_deleted_items
+        entry for entry in all_mails if entry.uid not in existing_deleted_items
     ]
 
     new_deleted_items: set[str] = await process_transactions(mails_list)
     logger.info(f"completed transactions. Deleted:{len(new_deleted_items)}")
     if new_deleted_items:
-        save_deleted_items(
-            deleted_items_path, existing_deleted_items.union(new_deleted_items)
+        await asyncio.to_thread(
+            append_deleted_items, deleted_items_path, new_deleted_items
         )
 
     logger.info("Saved deleted items")
+    if new_deleted_items and scfg().move_to_cur:
+        await move_done_mails(new_deleted_items)
+
+
+async def move_done_mails(uids: set[str]) -> None:
+    """Keeps new/ to mails not yet downloaded by someone
+
+    Deleted items are saved before checking, so of sessions of the same
+    mbox ending together, at least the last one sees all of them"""
+    mbox_path = scfg().mails_path / state().mbox
+    usernames = scfg().users.of_mbox(state().mbox)
+    if done := await asyncio.to_thread(done_by_all, mbox_path, usernames, uids):
+        moved = await asyncio.to_thread(move_to_cur, mbox_path, done)
+        metrics.POP_MOVED_MAILS.inc(amount=moved)
+        logger.info(f"Moved to cur/ {moved=}")
 
 
 async def start_session() -> None:
@@ -320,8 +551,7 @@ async def start_session() -> None:
         logger.exception("Serious client error")
         raise
     finally:
-        with contextlib.suppress(KeyError):
-            scfg().loggedin_users.remove(state().username)
+        scfg().unlock_session(state().username)
 
 
 def parse_users(users: list[User]) -> dict[str, tuple[PWInfo, str]]:
@@ -334,8 +564,43 @@ def parse_users(users: list[User]) -> dict[str, tuple[PWInfo, str]]:
     return dict(inner())
 
 
-def make_pop_server_callback(mails_path: Path, users: list[User], timeout_seconds: int):
-    s_state = SharedState(mails_path=mails_path, users=parse_users(users))
+class Users:
+    """Users by name, replaced as a whole when config is reloaded"""
+
+    def __init__(self, users: list[User]):
+        self.by_name = parse_users(users)
+
+    def __getitem__(self, username: str) -> tuple[PWInfo, str]:
+        return self.by_name[username]
+
+    def __len__(self) -> int:
+        return len(self.by_name)
+
+    def of_mbox(self, mbox: str) -> list[str]:
+        return [name for name, (_, umbox) in self.by_name.items() if umbox == mbox]
+
+
+def make_pop_server_callback(
+    mails_path: Path,
+    users: Union[list[User], Users],
+    timeout_seconds: int,
+    auth_workers: int,
+    auth_queue_size: int,
+    auth_cache_seconds: int,
+    auth_cache_size: int,
+    admission: Optional[Admission] = None,
+    move_to_cur: bool = False,
+):
+    s_state = SharedState(
+        mails_path=mails_path,
+        users=users if isinstance(users, Users) else Users(users),
+        auth_workers=auth_workers,
+        auth_queue_size=auth_queue_size,
+        auth_cache_seconds=auth_cache_seconds,
+        auth_cache_size=auth_cache_size,
+        admission=admission,
+        move_to_cur=move_to_cur,
+    )
 
     async def session_cb(reader: StreamReader, writer: StreamWriter):
         c_shared_state.set(s_state)
@@ -344,14 +609,19 @@ def make_pop_server_callback(mails_path: Path, users: list[User], timeout_second
             State(reader=reader, writer=writer, ip=ip, req_id=s_state.next_id())
         )
         logger.info("Got pop server callback")
+        metrics.POP_SESSIONS.inc()
+        metrics.POP_ACTIVE_SESSIONS.inc()
         try:
             try:
                 return await asyncio.wait_for(start_session(), timeout_seconds)
             finally:
+                flush_nowait()
                 writer.close()
                 await writer.wait_closed()
         except:
             logger.exception("unexpected exception")
+        finally:
+            metrics.POP_ACTIVE_SESSIONS.dec()
 
     return session_cb
 
@@ -360,18 +630,43 @@ async def create_pop_server(
     host: str,
     port: int,
     mails_path: Path,
-    users: list[User],
+    users: Union[list[User], Users],
     ssl_context: Optional[ssl.SSLContext] = None,
     timeout_seconds: int = 60,
+    auth_workers: int = 2,
+    auth_queue_size: int = 32,
+    auth_cache_seconds: int = 600,
+    auth_cache_size: int = 64,
+    reuse_port: bool = False,
+    admission: Optional[Admission] = None,
+    move_to_cur: bool = False,
 ) -> asyncio.Server:
     logging.info(
-        f"Starting POP3 server {host=}, {port=}, {mails_path=!s}, {len(users)=}, {bool(ssl_context)=}, {timeout_seconds=}"
+        f"Starting POP3 server {host=}, {port=}, {mails_path=!s}, {len(users)=}, {bool(ssl_context)=}, {timeout_seconds=}, {auth_workers=}, {reuse_port=}, {move_to_cur=}"
     )
-    return await asyncio.start_server(
-        make_pop_server_callback(mails_path, users, timeout_seconds),
+    session_cb = make_pop_server_callback(
+        mails_path,
+        users,
+        timeout_seconds,
+        auth_workers,
+        auth_queue_size,
+        auth_cache_seconds,
+        auth_cache_size,
+        admission,
+        move_to_cur,
+    )
+
+    def protocol_factory() -> asyncio.StreamReaderProtocol:
+        # Same as asyncio.start_server
+        return asyncio.StreamReaderProtocol(StreamReader(), session_cb)
+
+    return await create_server(
+        protocol_factory,
         host=host,
         port=port,
-        ssl=ssl_context,
+        ssl_context=ssl_context,
+        admission=admission,
+        reuse_port=reuse_port,
     )
 
 
@@ -1,4 +1,7 @@
 import os
+import hmac
+import time
+from collections import OrderedDict
 from hashlib import scrypt
 from base64 import b32encode, b32decode
 
@@ -58,6 +61,45 @@ def check_pass(password: str, pwinfo: PWInfo) -> bool:
     )
 
 
+class VerifiedCache:
+    """Remembers recently verified passwords to skip scrypt on repeat logins
+
+    Only a HMAC of the password keyed with a random per process key is kept.
+    Entries expire after ttl_seconds or when the user's password hash changes.
+    Least recently used entries are dropped beyond max_size users"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.key = os.urandom(32)
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[bytes, bytes, float]] = OrderedDict()
+
+    def mac(self, password: str) -> bytes:
+        return hmac.digest(self.key, password.encode(), "sha256")
+
+    def check(self, username: str, password: str, pwinfo: PWInfo) -> bool:
+        try:
+            mac, scrypt_hash, expiry = self.entries[username]
+        except KeyError:
+            return False
+        if scrypt_hash != pwinfo.scrypt_hash or expiry < time.monotonic():
+            del self.entries[username]
+            return False
+        if not hmac.compare_digest(mac, self.mac(password)):
+            return False
+        self.entries.move_to_end(username)
+        return True
+
+    def add(self, username: str, password: str, pwinfo: PWInfo) -> None:
+        if self.max_size <= 0:
+            return
+        expiry = time.monotonic() + self.ttl_seconds
+        self.entries[username] = self.mac(password), pwinfo.scrypt_hash, expiry
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
 if __name__ == "__main__":
     import sys
 
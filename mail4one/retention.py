@@ -0,0 +1,133 @@
+"""Removes mails of boxes with a retention policy, runs in the background
+
+Mails are picked in a thread and removed in small batches, each batch holds
+the mbox index lock only briefly so deliveries and POP3 logins don't wait.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from .config import Config, Mbox, RetentionCfg
+from .maildir import MailIndex, done_by_all, remove_mails
+from .poputils import MailEntry, get_mails_list
+from . import metrics
+
+logger = logging.getLogger("retention")
+
+BATCH_SIZE = 100
+
+# Mail to remove and why: age, downloaded or size
+Selected = tuple[MailEntry, str]
+
+
+def delivered_at(entry: MailEntry) -> Optional[float]:
+    """mtime of the mail, None if already removed
+
+    Not ctime, as the copies of a mail delivered to several mboxes are hard
+    links sharing it, and moving or removing any copy changes it for all"""
+    try:
+        return os.stat(entry.path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def select_mails(
+    mbox_path: Path, usernames: list[str], policy: RetentionCfg, now: float
+) -> list[Selected]:
+    new_mails = MailIndex(mbox_path).load()
+    cur_mails = get_mails_list(mbox_path / "cur")
+    downloaded: set[str] = set()
+    if policy.delete_downloaded and usernames:
+        # Everything in cur/ was moved there after all users got it
+        downloaded = done_by_all(
+            mbox_path, usernames, {entry.uid for entry in new_mails}
+        )
+        downloaded.update(entry.uid for entry in cur_mails)
+    max_age = policy.max_age_days * 24 * 3600
+    selected: list[Selected] = []
+    kept: list[tuple[float, MailEntry]] = []
+    for entry in new_mails + cur_mails:
+        if (delivered := delivered_at(entry)) is None:
+            continue
+        if max_age and now - delivered > max_age:
+            selected.append((entry, "age"))
+        elif entry.uid in downloaded:
+            selected.append((entry, "downloaded"))
+        else:
+            kept.append((delivered, entry))
+    if policy.max_size_mb:
+        excess = sum(entry.size for _, entry in kept) - policy.max_size_mb * 1024 * 1024
+        for _, entry in sorted(kept, key=lambda kept_entry: kept_entry[0]):
+            if excess <= 0:
+                break
+            selected.append((entry, "size"))
+            excess -= entry.size
+    return selected
+
+
+def remove_batch(mbox_path: Path, batch: list[Selected]) -> list[Selected]:
+    """Returns the mails removed, skips ones already gone"""
+    new_path = str(mbox_path / "new")
+    in_new = {entry.uid for entry, _ in batch if entry.dirpath == new_path}
+    removed = remove_mails(mbox_path, in_new) if in_new else set()
+    result = []
+    for entry, reason in batch:
+        if entry.dirpath == new_path:
+            if entry.uid not in removed:
+                continue
+        else:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+        result.append((entry, reason))
+    return result
+
+
+async def apply_retention(
+    mbox_path: Path, usernames: list[str], policy: RetentionCfg
+) -> int:
+    """Returns the bytes reclaimed"""
+    selected = await asyncio.to_thread(
+        select_mails, mbox_path, usernames, policy, time.time()
+    )
+    reclaimed = 0
+    for i in range(0, len(selected), BATCH_SIZE):
+        batch = selected[i : i + BATCH_SIZE]
+        for entry, reason in await asyncio.to_thread(remove_batch, mbox_path, batch):
+            metrics.RETENTION_REMOVED_MAILS.inc((reason,))
+            metrics.RETENTION_RECLAIMED_BYTES.inc((reason,), entry.size)
+            reclaimed += entry.size
+    return reclaimed
+
+
+async def run_retention(cfg: Config) -> None:
+    for box in cfg.boxes or []:
+        mbox = Mbox(box)
+        if not mbox.retention:
+            continue
+        policy = RetentionCfg(mbox.retention)
+        usernames = [user.username for user in cfg.users if user.mbox == mbox.name]
+        try:
+            reclaimed = await apply_retention(
+                Path(cfg.mails_path) / mbox.name, usernames, policy
+            )
+        except Exception:
+            logger.exception(f"Retention failed {mbox.name=}")
+            continue
+        logger.info(f"Retention done {mbox.name=} {reclaimed=}")
+
+
+async def retention_worker(get_cfg: Callable[[], Config]) -> None:
+    """get_cfg returns the current config, which may change on reload"""
+    while True:
+        cfg = get_cfg()
+        try:
+            await run_retention(cfg)
+        except Exception:
+            logger.exception("Retention run failed")
+        await asyncio.sleep(cfg.retention_interval_minutes * 60)
@@ -1,168 +1,430 @@
 import asyncio
+import atexit
+import contextlib
+import errno
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import signal
+import sys
 import ssl
-from argparse import ArgumentParser
+from functools import lru_cache
 from pathlib import Path
-from getpass import getpass
+from jata import asdict
 from typing import Optional, Union
 
 from .smtp import create_smtp_server_starttls, create_smtp_server
-from .pop3 import create_pop_server
+from .pop3 import create_pop_server, parse_users, Users
+from .metrics import create_metrics_server
+from .admission import Admission
+from .retention import retention_worker
 from .version import VERSION
 
 from . import config
-from . import pwhash
 
+# Contexts in use with their cert and key files, and mtimes when loaded
+loaded_certs: list[tuple[ssl.SSLContext, str, str, tuple[int, int]]] = []
 
-def create_tls_context(certfile, keyfile) -> ssl.SSLContext:
+
+def cert_mtimes(certfile: str, keyfile: str) -> tuple[int, int]:
+    return os.stat(certfile).st_mtime_ns, os.stat(keyfile).st_mtime_ns
+
+
+@lru_cache(maxsize=None)
+def create_tls_context(
+    certfile: str,
+    keyfile: str,
+    ciphers: str = "",
+    ecdh_curve: str = "",
+    num_tickets: int = 2,
+    session_tickets: bool = True,
+) -> ssl.SSLContext:
+    """Listeners with the same settings share the context, so a session
+    resumes on any of them"""
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    mtimes = cert_mtimes(certfile, keyfile)
     context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    loaded_certs.append((context, certfile, keyfile, mtimes))
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if ecdh_curve:
+        context.set_ecdh_curve(ecdh_curve)
+    context.num_tickets = num_tickets
+    if not session_tickets:
+        context.options |= ssl.OP_NO_TICKET
     return context
 
 
+def tls_context(tls: config.TLSCfg) -> ssl.SSLContext:
+    return create_tls_context(
+        tls.certfile,
+        tls.keyfile,
+        tls.ciphers,
+        tls.ecdh_curve,
+        tls.num_tickets,
+        tls.session_tickets,
+    )
+
+
+def reload_tls_certs() -> None:
+    """Loads renewed certificates (e.g. by certbot) into the contexts in use.
+    Listeners keep their context, so session tickets stay valid"""
+    for i, (context, certfile, keyfile, mtimes) in enumerate(loaded_certs):
+        try:
+            if (new_mtimes := cert_mtimes(certfile, keyfile)) == mtimes:
+                continue
+            # Check first, a failed load may leave the context half updated
+            check = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            check.load_cert_chain(certfile=certfile, keyfile=keyfile)
+            context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        except (OSError, ssl.SSLError):
+            logging.exception(f"Keeping old certificate {certfile=}")
+            continue
+        loaded_certs[i] = context, certfile, keyfile, new_mtimes
+        logging.info(f"Reloaded certificate {certfile=}")
+
+
+def preload_tls_contexts(cfg: config.Config) -> None:
+    """Creates contexts before fork, so workers share the session ticket keys
+    and a client resumes whichever worker it reaches"""
+    if cfg.default_tls:
+        tls_context(config.TLSCfg(cfg.default_tls))
+    for scfg in cfg.servers or []:
+        if scfg.server_type not in SERVER_CFGS:
+            continue
+        if tls_cfg := get_tls_cfg(cfg, SERVER_CFGS[scfg.server_type](scfg).tls):
+            tls_context(tls_cfg)
+
+
 def setup_logging(cfg: config.LogCfg):
     logging_format = (
         "%(asctime)s %(name)s %(levelname)s %(message)s @ %(filename)s:%(lineno)d"
     )
     if cfg.logfile == "CONSOLE":
         logging.basicConfig(level=cfg.level, format=logging_format)
+    elif cfg.queue:
+        # File is written by a background thread, event loop only enqueues
+        file_handler = logging.FileHandler(cfg.logfile)
+        file_handler.setFormatter(logging.Formatter(logging_format))
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        # Full format is applied by file_handler
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        logging.basicConfig(level=cfg.level, handlers=[queue_handler])
     else:
         logging.basicConfig(
             filename=cfg.logfile, level=cfg.level, format=logging_format
         )
 
 
-async def a_main(cfg: config.Config) -> None:
-    default_tls_context: Optional[ssl.SSLContext] = None
+def get_host(cfg: config.Config, host: str) -> str:
+    if host == "default":
+        return cfg.default_host
+    return host
 
-    if tls := cfg.default_tls:
-        logging.info(f"Initializing default tls {tls.certfile=}, {tls.keyfile=}")
-        default_tls_context = create_tls_context(tls.certfile, tls.keyfile)
 
-    def get_tls_context(tls: Union[config.TLSCfg, str]):
-        if tls == "default":
-            return default_tls_context
-        if tls == "disable":
-            return None
-        tls_cfg = config.TLSCfg(tls)
-        return create_tls_context(tls_cfg.certfile, tls_cfg.keyfile)
+def get_tls_cfg(
+    cfg: config.Config, tls: Union[config.TLSCfg, str]
+) -> Optional[config.TLSCfg]:
+    if tls == "default":
+        return config.TLSCfg(cfg.default_tls) if cfg.default_tls else None
+    if tls == "disable":
+        return None
+    return config.TLSCfg(tls)
 
-    def get_host(host):
-        if host == "default":
-            return cfg.default_host
-        return host
 
-    mbox_finder = config.gen_addr_to_mboxes(cfg)
-    servers: list[asyncio.Server] = []
+SERVER_CFGS = {
+    "pop": config.PopCfg,
+    "smtp_starttls": config.SmtpStartTLSCfg,
+    "smtp": config.SmtpCfg,
+    "metrics": config.MetricsCfg,
+}
 
-    if not cfg.servers:
-        logging.warning("Nothing to do!")
-        return
 
-    for scfg in cfg.servers:
+def port_of(server: asyncio.Server) -> int:
+    return server.sockets[0].getsockname()[1] if server.sockets else 0
+
+
+def server_key(cfg: config.Config, scfg: config.ServerCfg) -> str:
+    """Listener is rebound on reload only if this changes"""
+    typed = SERVER_CFGS[scfg.server_type](scfg)
+    tls = get_tls_cfg(cfg, typed.tls)
+    resolved = {
+        "host": get_host(cfg, typed.host),
+        "tls": asdict(tls) if tls else None,
+        "mails_path": cfg.mails_path,
+    }
+    return json.dumps({**asdict(typed), **resolved}, sort_keys=True)
+
+
+async def a_main(
+    cfg: config.Config,
+    worker_index: int = 0,
+    reuse_port: bool = False,
+    config_path: Optional[Path] = None,
+) -> None:
+    """Reloads config_path on SIGHUP, if passed"""
+    if tls := cfg.default_tls:
+        logging.info(f"Initializing default tls {tls.certfile=}, {tls.keyfile=}")
+
+    # Swapped in place on reload, servers keep referring to these
+    mbox_finder = config.MboxFinder(cfg)
+    users = Users(cfg.users)
+    admission: Optional[Admission] = None
+    # Opt-in, per process, with workers the limits apply to each worker
+    if cfg.admission:
+        acfg = config.AdmissionCfg(cfg.admission)
+        admission = Admission(
+            max_connections=acfg.max_connections,
+            max_connections_per_ip=acfg.max_connections_per_ip,
+            connects_per_minute=acfg.connects_per_minute,
+            connect_burst=acfg.connect_burst,
+            auth_fails_per_minute=acfg.auth_fails_per_minute,
+            auth_fail_burst=acfg.auth_fail_burst,
+        )
+    servers: dict[str, asyncio.Server] = {}
+
+    def get_tls_context(tls: Union[config.TLSCfg, str]) -> Optional[ssl.SSLContext]:
+        tls_cfg = get_tls_cfg(cfg, tls)
+        return tls_context(tls_cfg) if tls_cfg else None
+
+    async def create_server(scfg: config.ServerCfg) -> Optional[asyncio.Server]:
         if scfg.server_type == "pop":
             pop = config.PopCfg(scfg)
-            pop_server = await create_pop_server(
-                host=get_host(pop.host),
+            return await create_pop_server(
+                host=get_host(cfg, pop.host),
                 port=pop.port,
                 mails_path=Path(cfg.mails_path),
-                users=cfg.users,
+                users=users,
                 ssl_context=get_tls_context(pop.tls),
                 timeout_seconds=pop.timeout_seconds,
+                auth_workers=pop.auth_workers,
+                auth_queue_size=pop.auth_queue_size,
+                auth_cache_seconds=pop.auth_cache_seconds,
+                auth_cache_size=pop.auth_cache_size,
+                reuse_port=reuse_port,
+                move_to_cur=pop.move_to_cur,
+                admission=admission,
             )
-            servers.append(pop_server)
         elif scfg.server_type == "smtp_starttls":
             stls = config.SmtpStartTLSCfg(scfg)
             stls_context = get_tls_context(stls.tls)
             if not stls_context:
                 raise Exception("starttls requires ssl_context")
-            smtp_server_starttls = await create_smtp_server_starttls(
-                host=get_host(stls.host),
+            return await create_smtp_server_starttls(
+                host=get_host(cfg, stls.host),
                 port=stls.port,
                 mails_path=Path(cfg.mails_path),
                 mbox_finder=mbox_finder,
                 ssl_context=stls_context,
                 require_starttls=stls.require_starttls,
                 smtputf8=stls.smtputf8,
+                delivery_workers=stls.delivery_workers,
+                delivery_queue_size=stls.delivery_queue_size,
+                raw_delivery=stls.raw_delivery,
+                reuse_port=reuse_port,
+                admission=admission,
             )
-            servers.append(smtp_server_starttls)
         elif scfg.server_type == "smtp":
             smtp = config.SmtpCfg(scfg)
-            smtp_server = await create_smtp_server(
-                host=get_host(smtp.host),
+            return await create_smtp_server(
+                host=get_host(cfg, smtp.host),
                 port=smtp.port,
                 mails_path=Path(cfg.mails_path),
                 mbox_finder=mbox_finder,
                 ssl_context=get_tls_context(smtp.tls),
                 smtputf8=smtp.smtputf8,
+                delivery_workers=smtp.delivery_workers,
+                delivery_queue_size=smtp.delivery_queue_size,
+                raw_delivery=smtp.raw_delivery,
+                reuse_port=reuse_port,
+                admission=admission,
             )
-            servers.append(smtp_server)
-        else:
-            logging.error(f"Unknown server {scfg.server_type=}")
+        elif scfg.server_type == "metrics":
+            mcfg = config.MetricsCfg(scfg)
+            return await create_metrics_server(
+                host=get_host(cfg, mcfg.host), port=mcfg.port + worker_index
+            )
+        return None  # Unknown types are skipped by update_servers
 
-    if servers:
-        await asyncio.gather(*[server.serve_forever() for server in servers])
-    else:
+    def listen_port(scfg: config.ServerCfg) -> int:
+        port = SERVER_CFGS[scfg.server_type](scfg).port
+        return port + worker_index if scfg.server_type == "metrics" else port
+
+    def close_server(key: str) -> None:
+        server = servers.pop(key)
+        addrs = [sock.getsockname() for sock in server.sockets]
+        logging.info(f"Closing listener {addrs=}")
+        server.close()
+
+    async def update_servers() -> None:
+        """Starts new listeners, then closes ones not in cfg anymore.
+        Connections of closed listeners are not interrupted. If a listener
+        fails to start, the old ones are kept"""
+        wanted: dict[str, config.ServerCfg] = {}
+        for scfg in cfg.servers or []:
+            if scfg.server_type not in SERVER_CFGS:
+                logging.error(f"Unknown server {scfg.server_type=}")
+                continue
+            wanted[server_key(cfg, scfg)] = scfg
+        removed = servers.keys() - wanted.keys()
+        for key, scfg in wanted.items():
+            if key in servers:
+                continue
+            try:
+                server = await create_server(scfg)
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
+                # Without reuse_port, a changed listener on the same port
+                # can only bind once the old one is closed
+                port = listen_port(scfg)
+                for old in [k for k in removed if port_of(servers[k]) == port]:
+                    removed.discard(old)
+                    close_server(old)
+                server = await create_server(scfg)
+            if server:
+                await server.start_serving()
+                servers[key] = server
+        for key in removed:
+            close_server(key)
+
+    reload_lock = asyncio.Lock()
+
+    async def reload() -> None:
+        nonlocal cfg
+        assert config_path
+        async with reload_lock:
+            logging.info(f"Reloading {config_path=!s}")
+            try:
+                new_cfg = config.Config(config_path.read_text())
+                new_find = config.gen_addr_to_mboxes(new_cfg)
+                new_users = parse_users(new_cfg.users)
+            except Exception:
+                logging.exception("Reload failed, keeping current config")
+                return
+            reload_tls_certs()
+            # Both at once, no await in between
+            cfg = new_cfg
+            mbox_finder.find = new_find
+            users.by_name = new_users
+            try:
+                await update_servers()
+            except Exception:
+                logging.exception("Failed to update listeners")
+            logging.info(f"Reloaded {len(users)=} {len(servers)=}")
+
+    reloads: set[asyncio.Task] = set()
+
+    def on_sighup() -> None:
+        task = asyncio.create_task(reload())
+        reloads.add(task)
+        task.add_done_callback(reloads.discard)
+
+    if not cfg.servers:
         logging.warning("Nothing to do!")
+        return
 
+    loop = asyncio.get_running_loop()
+    # Before the servers start, so a SIGHUP meanwhile does not kill the process
+    if config_path:
+        loop.add_signal_handler(signal.SIGHUP, on_sighup)
+    retention = None
+    try:
+        async with reload_lock:
+            await update_servers()
+        if not servers:
+            logging.warning("Nothing to do!")
+            return
+        # One worker is enough, mboxes are shared by all
+        if worker_index == 0:
+            retention = asyncio.create_task(retention_worker(lambda: cfg))
+        # Servers are replaced on reload, so not waiting on their serve_forever
+        await asyncio.Event().wait()
+    finally:
+        if config_path:
+            loop.remove_signal_handler(signal.SIGHUP)
+        for task in [retention, *reloads]:
+            if task:
+                task.cancel()
+        for server in servers.values():
+            server.close()
 
-def main() -> None:
-    parser = ArgumentParser(
-        description="Personal Mail Server",
-        epilog="See https://gitea.balki.me/balki/mail4one for more info",
-    )
-    parser.add_argument("-v", "--version", action="version", version=VERSION)
-    parser.add_argument(
-        "-e",
-        "--echo_password",
-        action="store_true",
-        help="Show password in command line if -g without password is used",
-    )
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument(
-        "-c",
-        "--config",
-        metavar="CONFIG_PATH",
-        type=Path,
-        help="Run mail server with passed config",
-    )
-    group.add_argument(
-        "-g",
-        "--genpwhash",
-        nargs="?",
-        dest="password",
-        const="FROM_TERMINAL",
-        metavar="PASSWORD",
-        help="Generate password hash to add in config",
-    )
-    group.add_argument(
-        "-r",
-        "--pwverify",
-        dest="password_pwhash",
-        nargs=2,
-        metavar=("PASSWORD", "PWHASH"),
-        help="Check if password matches password hash",
-    )
-    args = parser.parse_args()
-    if password := args.password:
-        if password == "FROM_TERMINAL":
-            if args.echo_password:
-                password = input("Enter password: ")
-            else:
-                password = getpass("Enter password: ")
-        print(pwhash.gen_pwhash(password))
-    elif args.password_pwhash:
-        password, phash = args.password_pwhash
-        if pwhash.check_pass(password, pwhash.parse_hash(phash)):
-            print("✓ password and hash match")
+
+def run_worker(cfg: config.Config, worker_index: int, config_path: Path) -> None:
+    # Until a_main handles it, a reload must not kill the worker
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    setup_logging(config.LogCfg(cfg.logging))
+    # Parent forwards SIGINT as SIGTERM, exit normally to flush logs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logging.info(f"Starting worker {worker_index=} pid={os.getpid()}")
+    asyncio.run(a_main(cfg, worker_index, reuse_port=True, config_path=config_path))
+    sys.exit(0)
+
+
+def run_workers(cfg: config.Config, config_path: Path) -> None:
+    """Forks cfg.workers processes, all listen on the same ports (SO_REUSEPORT)
+
+    Exits when any worker exits, so the service manager can restart all"""
+    preload_tls_contexts(cfg)
+    workers: dict[int, int] = {}
+    for worker_index in range(cfg.workers):
+        if pid := os.fork():
+            workers[pid] = worker_index
         else:
-            print("✗ password and hash do not match")
-    else:
-        cfg = config.Config(args.config.read_text())
-        setup_logging(config.LogCfg(cfg.logging))
-        logging.info(f"Starting mail4one {VERSION} {args.config=!s}")
-        asyncio.run(a_main(cfg))
+            run_worker(cfg, worker_index, config_path)
+    # Set up after fork, threads of the log queue do not survive fork
+    setup_logging(config.LogCfg(cfg.logging))
+    logging.info(f"Started mail4one {VERSION} {len(workers)=}")
+    stopping = False
+
+    def stop(*_) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    def reload(*_) -> None:
+        # Each worker reloads config by itself, workers count is not changed
+        for pid in workers:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+    pid, status = os.wait()
+    worker_index = workers.pop(pid)
+    if not stopping:
+        logging.error(f"Worker exited, stopping all {worker_index=} {status=}")
+        stop()
+    while workers:
+        pid, _ = os.wait()
+        workers.pop(pid, None)
+    logging.info("All workers stopped")
+    sys.exit(0 if stopping else 1)
+
+
+def run(config_path: Path) -> None:
+    # Ignored until the handler is installed, reload may come right after start
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    cfg = config.Config(config_path.read_text())
+    if cfg.workers > 1:
+        run_workers(cfg, config_path)
+        return
+    setup_logging(config.LogCfg(cfg.logging))
+    logging.info(f"Starting mail4one {VERSION} {config_path=!s}")
+    asyncio.run(a_main(cfg, config_path=config_path))
 
 
 if __name__ == "__main__":
+    from .cli import main
+
     main()
@@ -1,84 +1,151 @@
 import asyncio
 import logging
 import ssl
-import uuid
-import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from pathlib import Path
-from typing import Callable, Optional
+from typing import BinaryIO, Callable, Optional
 from email.message import Message
 import email.policy
 from email.generator import BytesGenerator
-import tempfile
 
 from aiosmtpd.handlers import AsyncMessage
 from aiosmtpd.smtp import SMTP
 from aiosmtpd.smtp import Envelope as SMTPEnvelope
 from aiosmtpd.smtp import Session as SMTPSession
 
+from . import maildir
+from .admission import Admission, create_server
+from . import metrics
+
 logger = logging.getLogger("smtp")
 
 
+class DeliveryQueue:
+    """Runs blocking maildir writes in a thread pool
+
+    When more than workers + queue_size deliveries are pending, new ones wait
+    for a slot, delaying the response to DATA"""
+
+    def __init__(self, maildirs: maildir.Maildirs, workers: int, queue_size: int):
+        self.maildirs = maildirs
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="smtp_delivery"
+        )
+        self.slots = asyncio.Semaphore(workers + queue_size)
+        # Waiting for a slot or in the executor
+        self.pending = 0
+        self.peak_pending = 0
+
+    async def deliver(
+        self, mboxes: list[str], write: Callable[[BinaryIO], None]
+    ) -> str:
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        metrics.SMTP_DELIVERY_PENDING.inc()
+        try:
+            if self.slots.locked():
+                logger.warning(f"Delivery queue full, waiting, {self.pending=}")
+            async with self.slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self.executor, self.maildirs.deliver, mboxes, write
+                )
+        finally:
+            self.pending -= 1
+            metrics.SMTP_DELIVERY_PENDING.dec()
+
+
 class MyHandler(AsyncMessage):
     def __init__(
         self,
-        mails_path: Path,
+        delivery: DeliveryQueue,
         mbox_finder: Callable[[str], list[str]],
         listener_type: str,
+        raw_delivery: bool = False,
     ):
         super().__init__()
-        self.mails_path = mails_path
+        self.delivery = delivery
         self.mbox_finder = mbox_finder
         self.rcpt_tos = []
         self.peer = None
         self.starttls = False
         self.listener_type = listener_type
+        self.raw_delivery = raw_delivery
 
     async def handle_DATA(
         self, server: SMTP, session: SMTPSession, envelope: SMTPEnvelope
     ) -> str:
         self.rcpt_tos = envelope.rcpt_tos
         self.peer = session.peer
+        metrics.SMTP_RECEIVED_BYTES.inc(amount=len(envelope.original_content or b""))
         if session.ssl:
             self.starttls = True
+        if self.raw_delivery:
+            await self.handle_raw(envelope)
+            return "250 OK"
         return await super().handle_DATA(server, session, envelope)
 
-    async def handle_message(self, message: Message):  # type: ignore[override]
-        message["X-SSL"] = f"Type: {self.listener_type}, STARTTLS: {self.starttls}"
+    def x_ssl(self) -> str:
+        return f"Type: {self.listener_type}, STARTTLS: {self.starttls}"
+
+    async def deliver(self, write: Callable[[BinaryIO], None]) -> None:
         all_mboxes: set[str] = set()
         for addr in self.rcpt_tos:
             for mbox in self.mbox_finder(addr.lower()):
                 all_mboxes.add(mbox)
         if not all_mboxes:
             logger.warning(f"dropping message from: {self.peer}")
+            metrics.SMTP_DELIVERY_SECONDS.observe(0, ("dropped",))
             return
-        for mbox in all_mboxes:
-            for sub in ("new", "tmp", "cur"):
-                sub_path = self.mails_path / mbox / sub
-                sub_path.mkdir(mode=0o755, exist_ok=True, parents=True)
-        with tempfile.TemporaryDirectory() as tmpdir:
-            filename = f"{uuid.uuid4()}.eml"
-            temp_email_path = Path(tmpdir) / filename
-            with open(temp_email_path, "wb") as fp:
-                gen = BytesGenerator(fp, policy=email.policy.SMTP)
-                gen.flatten(message)
-            for mbox in all_mboxes:
-                shutil.copy(temp_email_path, self.mails_path / mbox / "new")
-            logger.info(
-                f"Saved mail at {filename} addrs: {','.join(self.rcpt_tos)}, mboxes: {','.join(all_mboxes)} peer: {self.peer}"
+        start = time.perf_counter()
+        try:
+            filename = await self.delivery.deliver(sorted(all_mboxes), write)
+        except:
+            metrics.SMTP_DELIVERY_SECONDS.observe(
+                time.perf_counter() - start, ("failed",)
             )
+            raise
+        metrics.SMTP_DELIVERY_SECONDS.observe(time.perf_counter() - start, ("saved",))
+        logger.info(
+            f"Saved mail at {filename} addrs: {','.join(self.rcpt_tos)}, mboxes: {','.join(all_mboxes)} peer: {self.peer}"
+        )
+
+    async def handle_raw(self, envelope: SMTPEnvelope) -> None:
+        """Saves the mail as received with trace headers prepended, no MIME parsing"""
+        trace = (
+            f"X-Peer: {self.peer}\r\n"
+            f"X-MailFrom: {envelope.mail_from}\r\n"
+            f"X-RcptTo: {', '.join(envelope.rcpt_tos)}\r\n"
+            f"X-SSL: {self.x_ssl()}\r\n"
+        ).encode()
+        content = envelope.original_content or b""
+
+        def write(fp: BinaryIO) -> None:
+            fp.write(trace)
+            fp.write(content)
+
+        await self.deliver(write)
+
+    async def handle_message(self, message: Message):  # type: ignore[override]
+        message["X-SSL"] = self.x_ssl()
+        await self.deliver(
+            lambda fp: BytesGenerator(fp, policy=email.policy.SMTP).flatten(message)
+        )
 
 
 def protocol_factory_starttls(
-    mails_path: Path,
+    delivery: DeliveryQueue,
     mbox_finder: Callable[[str], list[str]],
     context: ssl.SSLContext,
     require_starttls: bool,
     smtputf8: bool,
+    raw_delivery: bool,
 ):
     logger.info("Got smtp client cb starttls")
     try:
-        handler = MyHandler(mails_path, mbox_finder, "starttls")
+        handler = MyHandler(delivery, mbox_finder, "starttls", raw_delivery)
         smtp = SMTP(
             handler=handler,
             require_starttls=require_starttls,
@@ -92,11 +159,14 @@ def protocol_factory_starttls(
 
 
 def protocol_factory(
-    mails_path: Path, mbox_finder: Callable[[str], list[str]], smtputf8: bool
+    delivery: DeliveryQueue,
+    mbox_finder: Callable[[str], list[str]],
+    smtputf8: bool,
+    raw_delivery: bool,
 ):
     logger.info("Got smtp client cb")
     try:
-        handler = MyHandler(mails_path, mbox_finder, "plain")
+        handler = MyHandler(delivery, mbox_finder, "plain", raw_delivery)
         smtp = SMTP(handler=handler, enable_SMTPUTF8=smtputf8)
     except:
         logger.exception("Something went wrong")
@@ -112,23 +182,34 @@ async def create_smtp_server_starttls(
     ssl_context: ssl.SSLContext,
     require_starttls: bool,
     smtputf8: bool,
+    delivery_workers: int = 2,
+    delivery_queue_size: int = 16,
+    raw_delivery: bool = False,
+    reuse_port: bool = False,
+    admission: Optional[Admission] = None,
 ) -> asyncio.Server:
     logging.info(
-        f"Starting SMTP STARTTLS server {host=}, {port=}, {mails_path=!s}, {bool(ssl_context)=}"
+        f"Starting SMTP STARTTLS server {host=}, {port=}, {mails_path=!s}, {bool(ssl_context)=}, {delivery_workers=}, {raw_delivery=}, {reuse_port=}"
     )
-    loop = asyncio.get_event_loop()
-    return await loop.create_server(
+    return await create_server(
         partial(
             protocol_factory_starttls,
-            mails_path,
+            DeliveryQueue(
+                maildir.Maildirs(mails_path), delivery_workers, delivery_queue_size
+            ),
             mbox_finder,
             ssl_context,
             require_starttls,
             smtputf8,
+            raw_delivery,
         ),
         host=host,
         port=port,
+        # TLS starts after STARTTLS command
+        ssl_context=None,
+        admission=admission,
         start_serving=False,
+        reuse_port=reuse_port,
     )
 
 
@@ -139,17 +220,26 @@ async def create_smtp_server(
     mbox_finder: Callable[[str], list[str]],
     ssl_context: Optional[ssl.SSLContext],
     smtputf8: bool,
+    delivery_workers: int = 2,
+    delivery_queue_size: int = 16,
+    raw_delivery: bool = False,
+    reuse_port: bool = False,
+    admission: Optional[Admission] = None,
 ) -> asyncio.Server:
     logging.info(
-        f"Starting SMTP server {host=}, {port=}, {mails_path=!s}, {bool(ssl_context)=}"
+        f"Starting SMTP server {host=}, {port=}, {mails_path=!s}, {bool(ssl_context)=}, {delivery_workers=}, {raw_delivery=}, {reuse_port=}"
+    )
+    delivery = DeliveryQueue(
+        maildir.Maildirs(mails_path), delivery_workers, delivery_queue_size
     )
-    loop = asyncio.get_event_loop()
-    return await loop.create_server(
-        partial(protocol_factory, mails_path, mbox_finder, smtputf8),
+    return await create_server(
+        partial(protocol_factory, delivery, mbox_finder, smtputf8, raw_delivery),
         host=host,
         port=port,
-        ssl=ssl_context,
+        ssl_context=ssl_context,
+        admission=admission,
         start_serving=False,
+        reuse_port=reuse_port,
     )
 
 
@@ -0,0 +1,15 @@
+import subprocess
+from pathlib import Path
+
+
+def make_cert(tmp_path: Path) -> tuple[str, str]:
+    """Self signed certificate for localhost, needs openssl command"""
+    certfile, keyfile = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "ec"]
+        + ["-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import shutil
+import ssl
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+from mail4one import admission
+from mail4one.admission import Admission, RateLimiter
+from mail4one.config import User
+from mail4one.pop3 import create_pop_server
+
+from mail4one.pwhash import gen_pwhash
+
+from .certs import make_cert
+
+
+def setUpModule() -> None:
+    logging.basicConfig(level=logging.CRITICAL)
+
+
+def make_admission(**kwargs) -> Admission:
+    limits = dict(
+        max_connections=0,
+        max_connections_per_ip=0,
+        connects_per_minute=0,
+        connect_burst=0,
+        auth_fails_per_minute=0,
+        auth_fail_burst=0,
+    )
+    return Admission(**{**limits, **kwargs})
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_take(self) -> None:
+        limiter = RateLimiter(rate=1, burst=2)
+        with mock.patch("time.monotonic", return_value=100.0):
+            self.assertTrue(limiter.take("ip1"))
+            self.assertTrue(limiter.take("ip1"))
+            self.assertFalse(limiter.take("ip1"))
+            self.assertFalse(limiter.allowed("ip1"))
+            self.assertTrue(limiter.take("ip2"))
+        with mock.patch("time.monotonic", return_value=101.0):
+            self.assertTrue(limiter.take("ip1"))
+            self.assertFalse(limiter.take("ip1"))
+
+    def test_disabled(self) -> None:
+        limiter = RateLimiter(rate=0, burst=0)
+        self.assertTrue(all(limiter.take("ip") for _ in range(100)))
+        self.assertEqual(limiter.buckets, {})
+
+    def test_prune(self) -> None:
+        limiter = RateLimiter(rate=1, burst=2)
+        with mock.patch.object(admission, "MAX_TRACKED_IPS", 2):
+            with mock.patch("time.monotonic", return_value=100.0):
+                limiter.take("ip1")
+                limiter.take("ip2")
+            with mock.patch("time.monotonic", return_value=110.0):
+                limiter.take("ip3")
+        self.assertEqual(list(limiter.buckets), ["ip3"])
+
+
+class TestAdmission(unittest.TestCase):
+    def test_admit(self) -> None:
+        adm = make_admission(max_connections=3, max_connections_per_ip=2)
+        self.assertIsNone(adm.admit("ip1"))
+        self.assertIsNone(adm.admit("ip1"))
+        self.assertEqual(adm.admit("ip1"), "max_connections_per_ip")
+        self.assertIsNone(adm.admit("ip2"))
+        self.assertEqual(adm.admit("ip3"), "max_connections")
+        adm.release("ip1")
+        adm.release("ip1")
+        self.assertEqual(adm.active, {"ip2": 1})
+        self.assertIsNone(adm.admit("ip3"))
+
+    def test_connect_rate(self) -> None:
+        adm = make_admission(connects_per_minute=1, connect_burst=1)
+        self.assertIsNone(adm.admit("ip1"))
+        adm.release("ip1")
+        self.assertEqual(adm.admit("ip1"), "connect_rate")
+        self.assertEqual(adm.total, 0)
+
+
+class TestGate(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.admission.")
+        self.addCleanup(td.cleanup)
+        self.td_path = Path(td.name)
+        self.admission = make_admission(
+            max_connections_per_ip=1, auth_fails_per_minute=1, auth_fail_burst=1
+        )
+        self.port = await self.serve()
+
+    async def serve(self, ssl_context: Optional[ssl.SSLContext] = None) -> int:
+        users = [
+            User(username="foobar", password_hash=gen_pwhash("helloworld"), mbox="mbox")
+        ]
+        server = await create_pop_server(
+            host="127.0.0.1",
+            port=0,
+            mails_path=self.td_path,
+            users=users,
+            ssl_context=ssl_context,
+            admission=self.admission,
+        )
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return server.sockets[0].getsockname()[1]
+
+    async def connect(self, port: int = 0, **kwargs):
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", port or self.port, **kwargs
+        )
+        self.addCleanup(writer.close)
+        return reader, writer
+
+    async def test_max_per_ip(self) -> None:
+        r1, w1 = await self.connect()
+        self.assertEqual(await r1.readline(), b"+OK Server Ready\r\n")
+        r2, _ = await self.connect()
+        self.assertEqual(await r2.read(), b"", "closed without greeting")
+        w1.write(b"QUIT\r\n")
+        self.assertEqual(await r1.readline(), b"+OK Bye\r\n")
+        self.assertEqual(await r1.read(), b"")
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.admission.total, 0)
+        r3, _ = await self.connect()
+        self.assertEqual(await r3.readline(), b"+OK Server Ready\r\n")
+
+    async def test_auth_fails(self) -> None:
+        reader, writer = await self.connect()
+        await reader.readline()
+        writer.write(b"USER foobar\r\nPASS wrong\r\nUSER foobar\r\nPASS helloworld\r\n")
+        responses = [await reader.readline() for _ in range(4)]
+        self.assertEqual(responses[1], b"-ERR Auth Failed: Invalid user pass\r\n")
+        self.assertEqual(
+            responses[3], b"-ERR Auth Failed: Too many failed logins, try later\r\n"
+        )
+
+    @unittest.skipUnless(shutil.which("openssl"), "needs openssl command")
+    async def test_tls(self) -> None:
+        certfile, keyfile = make_cert(self.td_path)
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(certfile, keyfile)
+        port = await self.serve(server_context)
+        client_context = ssl.create_default_context(cafile=certfile)
+        r1, w1 = await self.connect(
+            port, ssl=client_context, server_hostname="localhost"
+        )
+        self.assertEqual(await r1.readline(), b"+OK Server Ready\r\n")
+        w1.write(b"USER foobar\r\n")
+        await w1.drain()
+        self.assertEqual(await r1.readline(), b"+OK Welcome\r\n")
+        self.assertEqual(self.admission.total, 1)
+        # Rejected before the handshake, the client sees the connection reset
+        with self.assertRaises((ssl.SSLError, ConnectionError)):
+            await self.connect(port, ssl=client_context, server_hostname="localhost")
+        self.assertEqual(len(admission.Gate.handshakes), 0)
+        w1.write(b"QUIT\r\n")
+        self.assertEqual(await r1.readline(), b"+OK Bye\r\n")
+
+    async def test_tls_closed_during_handshake(self) -> None:
+        port = await self.serve(ssl.create_default_context(ssl.Purpose.CLIENT_AUTH))
+        loop = asyncio.get_running_loop()
+        start_tls = mock.AsyncMock(return_value=None)
+        with mock.patch.object(loop, "start_tls", start_tls):
+            reader, _ = await self.connect(port)
+            self.assertEqual(await reader.read(), b"")
+        start_tls.assert_awaited_once()
+        self.assertEqual(self.admission.total, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
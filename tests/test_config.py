@@ -1,3 +1,4 @@
+import logging
 import unittest
 
 from mail4one import config
@@ -53,6 +54,10 @@ TEST_CONFIG = """
 """
 
 
+def setUpModule() -> None:
+    logging.basicConfig(level=logging.CRITICAL)
+
+
 class TestConfig(unittest.TestCase):
 
     def test_config(self) -> None:
@@ -73,6 +78,32 @@ class TestConfig(unittest.TestCase):
             config.get_mboxes("first.last@mydomain.com", rules), ["important", "all"]
         )
 
+    def test_gen_addr_to_mboxes(self) -> None:
+        cfg = config.Config(TEST_CONFIG)
+        mbox_finder = config.gen_addr_to_mboxes(cfg)
+        for _ in range(2):
+            mboxes = mbox_finder("first.last@mydomain.com")
+            self.assertEqual(mboxes, ["important", "all"])
+            mboxes.append("modified by caller")
+
+    def test_compile_rexs(self) -> None:
+        match_fn = config.compile_rexs([".*@mydomain.com", "(.)\\1@mydomain.com"])
+        self.assertTrue(match_fn("foo@mydomain.com"))
+        self.assertFalse(match_fn("foo@bar.com"))
+        match_fn = config.compile_rexs(["(a)\\1@bar.com", "(b)\\1@bar.com"])
+        self.assertTrue(match_fn("aa@bar.com"))
+        self.assertTrue(match_fn("bb@bar.com"))
+        self.assertFalse(match_fn("ab@bar.com"))
+
+    def test_compile_rexs_flags(self) -> None:
+        match_fn = config.compile_rexs(["abc@bar.com", "(?i)x@bar.com", "y@bar.com"])
+        self.assertTrue(match_fn("X@BAR.COM"))
+        self.assertFalse(match_fn("ABC@bar.com"), "flag must not leak to others")
+        self.assertFalse(match_fn("Y@bar.com"))
+        match_fn = config.compile_rexs(["abc@bar.com", "(?x) y @bar.com"])
+        self.assertTrue(match_fn("y@bar.com"))
+        self.assertFalse(match_fn("a bc@bar.com"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+from mail4one import maildir
+
+
+def make_old(path: Path) -> None:
+    """Move mtime to the past so index is not considered racy"""
+    os.utime(path, ns=(10**18, 10**18))
+
+
+class TestMailIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.maildir.")
+        self.addCleanup(td.cleanup)
+        self.mbox_path = Path(td.name) / "mbox"
+        (self.mbox_path / "new").mkdir(parents=True)
+        (self.mbox_path / "new" / "msg1.eml").write_bytes(b"hello\r\n")
+        make_old(self.mbox_path / "new")
+
+    def add_mail(self, filename: str, content: bytes) -> None:
+        maildir.add_mail(self.mbox_path, filename, lambda dst: dst.write_bytes(content))
+
+    def test_load(self) -> None:
+        index = maildir.MailIndex(self.mbox_path)
+        self.assertEqual([e.uid for e in index.load()], ["msg1.eml"])
+        self.assertTrue((self.mbox_path / maildir.INDEX_NAME).exists())
+        # Another reader uses the saved index
+        entries = maildir.MailIndex(self.mbox_path).load()
+        self.assertEqual([(e.uid, e.size) for e in entries], [("msg1.eml", 7)])
+
+    def test_add_mail(self) -> None:
+        index = maildir.MailIndex(self.mbox_path)
+        index.load()
+        self.add_mail("msg2.eml", b"hello world\r\n")
+        offset = index.offset
+        entries = index.load()
+        self.assertEqual(len(entries), 2)
+        self.assertGreater(index.offset, offset, "read only appended lines")
+        self.assertEqual(index.stamp, os.stat(self.mbox_path / "new").st_mtime_ns)
+
+    def test_snapshot(self) -> None:
+        index = maildir.MailIndex(self.mbox_path)
+        entries = index.load()
+        self.assertIs(index.load(), entries, "unchanged mbox is not read again")
+        self.add_mail("msg2.eml", b"hello world\r\n")
+        self.assertEqual(len(index.load()), 2)
+
+    def test_removed_outside(self) -> None:
+        index = maildir.MailIndex(self.mbox_path)
+        index.load()
+        (self.mbox_path / "new" / "msg1.eml").unlink()
+        self.add_mail("msg2.eml", b"hello world\r\n")
+        self.assertEqual([e.uid for e in index.load()], ["msg2.eml"])
+
+    def test_move_to_cur(self) -> None:
+        (self.mbox_path / "new" / "msg2.eml").write_bytes(b"hello world\r\n")
+        make_old(self.mbox_path / "new")
+        index = maildir.MailIndex(self.mbox_path)
+        index.load()
+        moved = maildir.move_to_cur(self.mbox_path, {"msg1.eml", "missing"})
+        self.assertEqual(moved, 1)
+        self.assertTrue((self.mbox_path / "cur" / "msg1.eml:2,S").exists())
+        with mock.patch.object(index, "rebuild") as rebuild:
+            self.assertEqual([e.uid for e in index.load()], ["msg2.eml"])
+        rebuild.assert_not_called()
+
+    def test_done_by_all(self) -> None:
+        (self.mbox_path / "user1").write_text("a\nb\n")
+        (self.mbox_path / "user2").write_text("b\nc\npartial")
+        uids = {"a", "b", "c", "partial"}
+        done = maildir.done_by_all(self.mbox_path, ["user1", "user2"], uids)
+        self.assertEqual(done, {"b"})
+        done = maildir.done_by_all(self.mbox_path, ["user1", "user3"], uids)
+        self.assertEqual(done, set())
+
+    def test_no_new_dir(self) -> None:
+        index = maildir.MailIndex(Path(self.mbox_path.parent / "nombox"))
+        self.assertEqual(index.load(), [])
+
+
+class TestMaildirs(unittest.TestCase):
+
+    def test_deliver(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.maildir.")
+        self.addCleanup(td.cleanup)
+        mails_path = Path(td.name)
+        maildirs = maildir.Maildirs(mails_path)
+        filename = maildirs.deliver(["mbox1", "mbox2"], lambda fp: fp.write(b"hi\r\n"))
+        paths = [mails_path / mbox / "new" / filename for mbox in ("mbox1", "mbox2")]
+        for path in paths:
+            self.assertEqual(path.read_bytes(), b"hi\r\n")
+        self.assertTrue(paths[0].samefile(paths[1]), "written once")
+        self.assertEqual(list((mails_path / "mbox1" / "tmp").iterdir()), [])
+
+        # Recreated if removed outside
+        for path in paths:
+            path.unlink()
+        (mails_path / "mbox1" / "new").rmdir()
+        filename = maildirs.deliver(["mbox1"], lambda fp: fp.write(b"hi\r\n"))
+        self.assertTrue((mails_path / "mbox1" / "new" / filename).exists())
+
+        # Only the removed mbox is created again, others get the mail once
+        shutil.rmtree(mails_path / "mbox2")
+        filename = maildirs.deliver(["mbox1", "mbox2"], lambda fp: fp.write(b"hi\r\n"))
+        self.assertTrue((mails_path / "mbox1" / "new" / filename).exists())
+        self.assertEqual(os.listdir(mails_path / "mbox2" / "new"), [filename])
+
+
+if __name__ == "__main__":
+    unittest.main()
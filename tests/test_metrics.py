@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from mail4one import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self) -> None:
+        hist = metrics.Histogram("test_seconds", "Test", ("kind",), buckets=(0.1, 1.0))
+        self.addCleanup(metrics.REGISTRY.remove, hist)
+        hist.observe(0.05, ("a",))
+        hist.observe(0.5, ("a",))
+        hist.observe(5, ("a",))
+        self.assertEqual(hist.count(("a",)), 3)
+        self.assertEqual(hist.count(("b",)), 0)
+        self.assertEqual(
+            list(hist.render()),
+            [
+                "# HELP test_seconds Test",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{kind="a",le="0.1"} 1',
+                'test_seconds_bucket{kind="a",le="1.0"} 2',
+                'test_seconds_bucket{kind="a",le="+Inf"} 3',
+                'test_seconds_sum{kind="a"} 5.55',
+                'test_seconds_count{kind="a"} 3',
+            ],
+        )
+
+    def test_counter(self) -> None:
+        counter = metrics.Counter("test_total", "Test")
+        self.addCleanup(metrics.REGISTRY.remove, counter)
+        counter.inc()
+        counter.inc(amount=2)
+        self.assertEqual(counter.get(), 3)
+        self.assertIn("test_total 3", list(counter.render()))
+
+
+class TestMetricsServer(unittest.IsolatedAsyncioTestCase):
+    async def test_scrape(self) -> None:
+        server = await metrics.create_metrics_server("127.0.0.1", 0)
+        await server.start_serving()
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+
+        async def get(path: str) -> bytes:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        response = await get("/metrics")
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"# TYPE mail4one_pop_command_seconds histogram", response)
+        self.assertTrue((await get("/other")).startswith(b"HTTP/1.0 404"))
+
+        # Idle clients are disconnected
+        with mock.patch.object(metrics, "REQUEST_TIMEOUT_SECONDS", 0.05):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            self.addCleanup(writer.close)
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,8 +5,15 @@ import tempfile
 import time
 import os
 import poplib
+import threading
+from mail4one import pop3
 from mail4one.pop3 import create_pop_server
 from mail4one.config import User
+from mail4one.pwhash import check_pass
+from mail4one.poputils import dot_stuff, parse_command, Command, InvalidCommand
+from mail4one.poputils import ClientError, MailList, MailEntry
+from mail4one import poputils
+from unittest import mock
 from pathlib import Path
 
 TEST_HASH = "".join(
@@ -143,11 +150,12 @@ class TestPop3(unittest.IsolatedAsyncioTestCase):
         S: +OK Welcome
         C: PASS helloworld
         """
-        await self.dialog_checker_impl(r1, w1, dialog)
-        await self.dialog_checker_impl(r2, w2, dialog)
         d1 = """S: +OK Login successful"""
         d2 = """S: -ERR Auth Failed: Already logged in"""
+        # Passwords are checked in parallel, so let first login finish first
+        await self.dialog_checker_impl(r1, w1, dialog)
         await self.dialog_checker_impl(r1, w1, d1)
+        await self.dialog_checker_impl(r2, w2, dialog)
         await self.dialog_checker_impl(r2, w2, d2)
         end_dialog = """
         C: QUIT
@@ -164,6 +172,39 @@ class TestPop3(unittest.IsolatedAsyncioTestCase):
         """
         await self.dialog_checker(dialog)
 
+    async def test_RSET(self) -> None:
+        await self.do_login()
+        dialog = """
+        C: DELE 1
+        S: +OK Deleted
+        C: STAT
+        S: +OK 1 436
+        C: RSET
+        S: +OK Reset
+        C: STAT
+        S: +OK 2 872
+        """
+        await self.dialog_checker(dialog)
+
+    async def test_DELE_saved_off_loop(self) -> None:
+        threads = []
+
+        def append_deleted_items(path: Path, deleted_items: set[str]) -> None:
+            threads.append(threading.current_thread())
+
+        await self.do_login()
+        dialog = """
+        C: DELE 1
+        S: +OK Deleted
+        C: QUIT
+        S: +OK Bye
+        """
+        with mock.patch.object(pop3, "append_deleted_items", append_deleted_items):
+            await self.dialog_checker(dialog)
+            self.assertEqual(await self.reader.read(), b"")
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
     async def test_NOOP(self) -> None:
         await self.do_login()
         dialog = """
@@ -211,12 +252,47 @@ class TestPop3(unittest.IsolatedAsyncioTestCase):
         C: CAPA
         S: +OK Following are supported
         S: USER
+        S: PIPELINING
         S: .
         C: QUIT
         S: +OK Bye
         """
         await self.dialog_checker(dialog)
 
+    async def test_PIPELINING(self) -> None:
+        await self.do_login()
+        self.writer.write(b"STAT\r\nLIST 1\r\nUIDL 2\r\nDELE 1\r\nSTAT\r\n")
+        dialog = """
+        S: +OK 2 872
+        S: +OK 1 436
+        S: +OK 2 msg1.eml
+        S: +OK Deleted
+        S: +OK 1 436
+        """
+        await self.dialog_checker(dialog)
+
+    async def test_PIPELINING_bounded(self) -> None:
+        await self.do_login()
+        written: list[int] = []
+        flush_nowait = pop3.flush_nowait
+
+        def record_flush() -> None:
+            written.append(sum(map(len, pop3.state().out)))
+            flush_nowait()
+
+        listing = "S: +OK Mails follow\nS: 1 436\nS: 2 436\nS: ."
+        with mock.patch.object(pop3, "flush_nowait", record_flush):
+            self.writer.write(b"LIST\r\n" * 200)
+            for _ in range(200):
+                await self.dialog_checker(listing)
+            self.assertLess(max(written), 100, "each listing is sent on its own")
+            written.clear()
+            with mock.patch.object(pop3, "FLUSH_SIZE", 100):
+                self.writer.write(b"NOOP\r\n" * 200)
+                for _ in range(200):
+                    await self.dialog_checker("S: +OK Hmm")
+            self.assertLess(max(written), 100 + len(b"+OK Hmm\r\n"))
+
     async def test_poplib(self) -> None:
         def run_poplib():
             pc = poplib.POP3("127.0.0.1", 7995)
@@ -260,5 +336,188 @@ class TestPop3(unittest.IsolatedAsyncioTestCase):
                 self.assertEqual(data, resp)
 
 
+class TestAuthPool(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self) -> None:
+        # One check at a time, no queue, so a second login is refused
+        server = await create_pop_server(
+            host="127.0.0.1",
+            port=0,
+            mails_path=MAILS_PATH,
+            users=USERS,
+            auth_workers=1,
+            auth_queue_size=0,
+            auth_cache_size=0,
+        )
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        await server.start_serving()
+        self.port = server.sockets[0].getsockname()[1]
+        self.released = threading.Event()
+        self.addCleanup(self.released.set)
+
+    async def login(self, username: str) -> asyncio.StreamReader:
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.addAsyncCleanup(writer.wait_closed)
+        self.addCleanup(writer.close)
+        writer.write(f"USER {username}\r\n".encode())
+        self.assertEqual(await reader.readline(), b"+OK Server Ready\r\n")
+        self.assertEqual(await reader.readline(), b"+OK Welcome\r\n")
+        writer.write(b"PASS helloworld\r\n")
+        return reader
+
+    async def test_busy(self) -> None:
+        started = threading.Event()
+
+        def blocking_check(password: str, pwinfo) -> bool:
+            started.set()
+            self.released.wait(5)
+            return check_pass(password, pwinfo)
+
+        with mock.patch.object(pop3, "check_pass", blocking_check):
+            r1 = await self.login(TEST_USER)
+            self.assertTrue(await asyncio.to_thread(started.wait, 5))
+            r2 = await self.login(TEST_USER2)
+            self.assertEqual(await r2.readline(), b"-ERR Auth Failed: Server busy\r\n")
+            self.released.set()
+            self.assertEqual(await r1.readline(), b"+OK Login successful\r\n")
+
+    async def test_login(self) -> None:
+        reader = await self.login(TEST_USER2)
+        self.assertEqual(await reader.readline(), b"+OK Login successful\r\n")
+
+
+class TestParseCommand(unittest.TestCase):
+
+    def test_parse(self) -> None:
+        req = parse_command(b"PASS hello world  foo  bar \r\n")
+        self.assertEqual(req.cmd, Command.PASS)
+        self.assertEqual((req.arg1, req.arg2, req.rest), ("hello", "world", "foo  bar"))
+        req = parse_command(b"list 2\r\n")
+        self.assertEqual((req.cmd, req.arg1, req.arg2), (Command.LIST, "2", ""))
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(InvalidCommand):
+            parse_command(b"HELO\r\n")
+        with self.assertRaises(InvalidCommand):
+            parse_command(b" \r\n")
+        with self.assertRaises(ClientError):
+            parse_command(b"STAT\n")
+
+
+class TestMailList(unittest.TestCase):
+
+    def test_mail_list(self) -> None:
+        entries = [
+            MailEntry(uid=f"msg{i}", size=i * 10, c_time=i, dirpath="/tmp")
+            for i in range(1, 4)
+        ]
+        mails = MailList(entries)
+        self.assertEqual(mails.compute_stat(), (3, 60))
+        self.assertEqual(mails.get("1").uid, "msg3", "newest first")
+        for nid in ("0", "4", "-1", "a", ""):
+            self.assertIsNone(mails.get(nid))
+        mails.delete("1")
+        self.assertIsNone(mails.get("1"))
+        self.assertEqual(mails.compute_stat(), (2, 30))
+        self.assertEqual([nid for nid, _ in mails.get_all()], [2, 3])
+        self.assertEqual(mails.deleted_uids, {"msg3"})
+        with self.assertRaises(KeyError):
+            mails.delete("1")
+        mails.reset()
+        self.assertEqual(mails.compute_stat(), (3, 60))
+        self.assertEqual(mails.deleted_uids, set())
+
+
+class TestDeletedItems(unittest.TestCase):
+
+    def test_journal(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.pop.")
+        self.addCleanup(td.cleanup)
+        path = Path(td.name) / "user"
+        self.assertEqual(pop3.get_deleted_items(path), set())
+        pop3.append_deleted_items(path, {"a", "b"})
+        pop3.append_deleted_items(path, {"c"})
+        with path.open("a") as f:
+            f.write("partial")
+        self.assertEqual(pop3.get_deleted_items(path), {"a", "b", "c"})
+        # Append after a torn line doesn't extend it
+        pop3.append_deleted_items(path, {"d"})
+        self.assertEqual(pop3.get_deleted_items(path), {"a", "b", "c", "partial", "d"})
+
+    def test_compact(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.pop.")
+        self.addCleanup(td.cleanup)
+        path = Path(td.name) / "user"
+        items = {f"msg{i}" for i in range(pop3.COMPACT_MIN_ITEMS)}
+        pop3.append_deleted_items(path, items)
+        self.assertEqual(pop3.compact_deleted_items(path, items, items), items)
+        uids = {"msg1", "msg2", "new"}
+        live = {"msg1", "msg2"}
+        self.assertEqual(pop3.compact_deleted_items(path, items, uids), live)
+        self.assertEqual(pop3.get_deleted_items(path), live)
+        self.assertEqual(list(Path(td.name).iterdir()), [path])
+
+
+class TestGetMailsList(unittest.TestCase):
+
+    def test_scan(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.pop.")
+        self.addCleanup(td.cleanup)
+        path = Path(td.name)
+        for i in range(10):
+            (path / f"msg{i}").write_bytes(b"x" * i)
+        (path / "subdir").mkdir()
+        (path / "link").symlink_to(path / "msg1")
+        (path / "broken").symlink_to(path / "missing")
+
+        mails = poputils.get_mails_list(path)
+        self.assertEqual(
+            sorted((m.uid, m.size) for m in mails),
+            [("link", 1)] + [(f"msg{i}", i) for i in range(10)],
+        )
+        with mock.patch.object(poputils, "PARALLEL_SCAN_MIN", 2), mock.patch.object(
+            poputils, "SCAN_CHUNK", 3
+        ):
+            parallel = poputils.get_mails_list(path)
+        self.assertEqual(
+            sorted((m.uid, m.size, m.c_time) for m in parallel),
+            sorted((m.uid, m.size, m.c_time) for m in mails),
+        )
+        self.assertEqual(poputils.get_mails_list(path / "missing"), [])
+
+
+class TestSessionLock(unittest.TestCase):
+    def test_lock_session(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.pop.")
+        self.addCleanup(td.cleanup)
+        # Each worker process has its own shared state
+        users = pop3.Users(USERS)
+        s1, s2 = (pop3.SharedState(Path(td.name), users, 1, 1, 0, 0) for _ in range(2))
+        self.assertTrue(s1.lock_session("user", "mbox"))
+        self.assertFalse(s1.lock_session("user", "mbox"))
+        self.assertFalse(s2.lock_session("user", "mbox"))
+        self.assertTrue(s2.lock_session("user2", "mbox"))
+        s1.unlock_session("user")
+        self.assertTrue(s2.lock_session("user", "mbox"))
+        s2.unlock_session("user")
+        s2.unlock_session("user2")
+
+
+class TestDotStuff(unittest.TestCase):
+
+    def test_chunks(self) -> None:
+        mail = b".first\r\nmid\r\n..two\r\n.\r\nlast\r\n"
+        expected = b"..first\r\nmid\r\n...two\r\n..\r\nlast\r\n"
+        for size in range(1, len(mail) + 1):
+            chunks = [mail[i : i + size] for i in range(0, len(mail), size)]
+            at_line_start = True
+            stuffed = b""
+            for chunk in chunks:
+                stuffed += dot_stuff(chunk, at_line_start)
+                at_line_start = chunk.endswith(b"\n")
+            self.assertEqual(stuffed, expected, f"{size=}")
+
+
 if __name__ == "__main__":
     unittest.main()
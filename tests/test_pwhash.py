@@ -1,4 +1,5 @@
 from mail4one.pwhash import gen_pwhash, parse_hash, check_pass, SALT_LEN, KEY_LEN
+from mail4one.pwhash import VerifiedCache
 import unittest
 
 
@@ -36,5 +37,33 @@ class TestPWHash(unittest.TestCase):
             parse_hash("sdlfkjdsklfjdsk")
 
 
+class TestVerifiedCache(unittest.TestCase):
+
+    def test_cache(self):
+        pwinfo = parse_hash(gen_pwhash("secret"))
+        cache = VerifiedCache(ttl_seconds=60, max_size=2)
+        self.assertFalse(cache.check("user1", "secret", pwinfo))
+        cache.add("user1", "secret", pwinfo)
+        self.assertTrue(cache.check("user1", "secret", pwinfo))
+        self.assertFalse(cache.check("user1", "wrong", pwinfo))
+        self.assertFalse(cache.check("user2", "secret", pwinfo))
+
+        changed = parse_hash(gen_pwhash("secret"))
+        self.assertFalse(cache.check("user1", "secret", changed), "hash changed")
+        self.assertFalse(cache.check("user1", "secret", pwinfo), "evicted")
+
+    def test_lru_and_ttl(self):
+        pwinfo = parse_hash(gen_pwhash("secret"))
+        cache = VerifiedCache(ttl_seconds=60, max_size=2)
+        for user in ("user1", "user2", "user3"):
+            cache.add(user, "secret", pwinfo)
+        self.assertFalse(cache.check("user1", "secret", pwinfo))
+        self.assertTrue(cache.check("user3", "secret", pwinfo))
+
+        cache = VerifiedCache(ttl_seconds=-1, max_size=2)
+        cache.add("user1", "secret", pwinfo)
+        self.assertFalse(cache.check("user1", "secret", pwinfo))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from mail4one import config, maildir, metrics, pop3, retention
+
+
+def setUpModule() -> None:
+    logging.basicConfig(level=logging.CRITICAL)
+
+
+class TestRetention(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.retention.")
+        self.addCleanup(td.cleanup)
+        self.mails_path = Path(td.name)
+        self.mbox_path = self.mails_path / "mbox"
+        for sub in ("new", "cur"):
+            (self.mbox_path / sub).mkdir(parents=True)
+        for i in range(4):
+            (self.mbox_path / "new" / f"msg{i}").write_bytes(
+                b"x" * 256 * 1024 * (i + 1)
+            )
+            time.sleep(0.01)  # Distinct ctimes
+        (self.mbox_path / "cur" / "old:2,S").write_bytes(b"y" * 100)
+
+    def select(self, now: float = 0, **policy) -> dict[str, str]:
+        selected = retention.select_mails(
+            self.mbox_path,
+            ["user1", "user2"],
+            config.RetentionCfg(policy),
+            now or time.time(),
+        )
+        return {entry.uid: reason for entry, reason in selected}
+
+    def test_select(self) -> None:
+        self.assertEqual(self.select(), {})
+        self.assertEqual(len(self.select(time.time() + 2 * 86400, max_age_days=1)), 5)
+        pop3.append_deleted_items(self.mbox_path / "user1", {"msg0", "msg1"})
+        pop3.append_deleted_items(self.mbox_path / "user2", {"msg1"})
+        self.assertEqual(
+            self.select(delete_downloaded=True),
+            {"msg1": "downloaded", "old:2,S": "downloaded"},
+        )
+        # 2.5mb in total, oldest go first
+        self.assertEqual(self.select(max_size_mb=2), {"msg0": "size", "msg1": "size"})
+
+    def test_age_from_delivery(self) -> None:
+        day = 24 * 3600
+        msg0 = self.mbox_path / "new" / "msg0"
+        os.utime(msg0, (time.time() - 2 * day, time.time() - 2 * day))
+        # Changes ctime of all copies, not the age
+        os.link(msg0, self.mails_path / "copy")
+        (self.mails_path / "copy").unlink()
+        self.assertEqual(self.select(max_age_days=1), {"msg0": "age"})
+
+    async def test_apply(self) -> None:
+        pop3.append_deleted_items(self.mbox_path / "user1", {"msg0"})
+        index = maildir.MailIndex(self.mbox_path)
+        index.load()
+        before = metrics.RETENTION_RECLAIMED_BYTES.get(("downloaded",))
+        reclaimed = await retention.apply_retention(
+            self.mbox_path, ["user1"], config.RetentionCfg({"delete_downloaded": True})
+        )
+        self.assertEqual(reclaimed, 262244)
+        self.assertEqual(
+            metrics.RETENTION_RECLAIMED_BYTES.get(("downloaded",)), before + 262244
+        )
+        self.assertEqual(os.listdir(self.mbox_path / "cur"), [])
+        self.assertEqual(sorted(e.uid for e in index.load()), ["msg1", "msg2", "msg3"])
+
+    async def test_run(self) -> None:
+        cfg = config.Config(
+            {
+                "mails_path": str(self.mails_path),
+                "matches": [],
+                "users": [],
+                "servers": [],
+                "boxes": [
+                    {"name": "other", "rules": []},
+                    {"name": "mbox", "rules": [], "retention": {"max_size_mb": 1}},
+                ],
+            }
+        )
+        await retention.run_retention(cfg)
+        self.assertEqual(len(os.listdir(self.mbox_path / "new")), 0)
+        self.assertEqual(os.listdir(self.mbox_path / "cur"), ["old:2,S"])
+
+    async def test_worker_survives(self) -> None:
+        cfg = config.Config({"retention_interval_minutes": 0})
+        runs = []
+
+        async def run_retention(cfg: config.Config) -> None:
+            runs.append(cfg)
+            if len(runs) == 3:
+                raise asyncio.CancelledError
+            raise OSError("boom")
+
+        with mock.patch.object(retention, "run_retention", run_retention):
+            with self.assertRaises(asyncio.CancelledError):
+                await retention.retention_worker(lambda: cfg)
+        self.assertEqual(len(runs), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import os
+import poplib
+import shutil
+import signal
+import ssl
+import tempfile
+import unittest
+from pathlib import Path
+
+from mail4one import config, server
+from mail4one.pwhash import gen_pwhash
+
+from .certs import make_cert
+
+
+def setUpModule() -> None:
+    logging.basicConfig(level=logging.CRITICAL)
+
+
+def make_cfg(mails_path: str, username: str, servers: list[dict]) -> dict:
+    return {
+        "mails_path": mails_path,
+        "matches": [],
+        "boxes": [],
+        "users": [
+            {"username": username, "password_hash": PW_HASH, "mbox": "mbox"},
+        ],
+        "servers": servers,
+    }
+
+
+PW_HASH = gen_pwhash("password")
+
+
+class TestServerKey(unittest.TestCase):
+    def test_server_key(self) -> None:
+        cfg = config.Config(make_cfg("/tmp", "user", []))
+        pop = config.ServerCfg({"server_type": "pop", "port": 1995})
+        explicit = config.ServerCfg(
+            {"server_type": "pop", "port": 1995, "tls": "default", "host": "0.0.0.0"}
+        )
+        other_port = config.ServerCfg({"server_type": "pop", "port": 1996})
+        key = server.server_key(cfg, pop)
+        self.assertEqual(server.server_key(cfg, explicit), key)
+        self.assertNotEqual(server.server_key(cfg, other_port), key)
+        cfg.default_tls = {"certfile": "cert", "keyfile": "key"}
+        self.assertNotEqual(server.server_key(cfg, pop), key, "default tls changed")
+
+
+class TestPreloadTls(unittest.TestCase):
+    def test_no_tls(self) -> None:
+        self.addCleanup(server.loaded_certs.clear)
+        self.addCleanup(server.create_tls_context.cache_clear)
+        servers = [{"server_type": "pop", "port": 1995}]
+        server.preload_tls_contexts(config.Config(make_cfg("/tmp", "user", servers)))
+        self.assertEqual(server.loaded_certs, [])
+
+    @unittest.skipUnless(shutil.which("openssl"), "needs openssl command")
+    def test_default_tls(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.server.")
+        self.addCleanup(td.cleanup)
+        self.addCleanup(server.loaded_certs.clear)
+        self.addCleanup(server.create_tls_context.cache_clear)
+        certfile, keyfile = make_cert(Path(td.name))
+        servers = [
+            {"server_type": "pop", "port": 1995},
+            {"server_type": "smtp", "port": 1025, "tls": "disable"},
+        ]
+        cfg = config.Config(make_cfg(td.name, "user", servers))
+        cfg.default_tls = {"certfile": certfile, "keyfile": keyfile}
+        server.preload_tls_contexts(cfg)
+        self.assertEqual(len(server.loaded_certs), 1)
+
+
+@unittest.skipUnless(shutil.which("openssl"), "needs openssl command")
+class TestReloadCerts(unittest.IsolatedAsyncioTestCase):
+    async def test_reload_certs(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.server.")
+        self.addCleanup(td.cleanup)
+        certfile, keyfile = make_cert(Path(td.name))
+        context = server.create_tls_context(certfile, keyfile)
+        self.addCleanup(server.loaded_certs.clear)
+        self.addCleanup(server.create_tls_context.cache_clear)
+        tls_server = await asyncio.start_server(
+            lambda r, w: w.close(), "127.0.0.1", 0, ssl=context
+        )
+        self.addAsyncCleanup(tls_server.wait_closed)
+        self.addCleanup(tls_server.close)
+        port = tls_server.sockets[0].getsockname()[1]
+
+        async def served_cert() -> bytes:
+            client = ssl.create_default_context()
+            client.check_hostname = False
+            client.verify_mode = ssl.CERT_NONE
+            _, writer = await asyncio.open_connection("127.0.0.1", port, ssl=client)
+            cert = writer.get_extra_info("ssl_object").getpeercert(binary_form=True)
+            writer.close()
+            return cert
+
+        def file_cert() -> bytes:
+            return ssl.PEM_cert_to_DER_cert(Path(certfile).read_text())
+
+        self.assertEqual(await served_cert(), file_cert())
+        make_cert(Path(td.name))  # Renewed at the same path
+        server.reload_tls_certs()
+        self.assertEqual(await served_cert(), file_cert())
+        self.assertIs(server.create_tls_context(certfile, keyfile), context)
+
+        renewed = file_cert()
+        Path(certfile).write_text("broken")
+        os.utime(certfile, ns=(0, 0))  # Changed even within the clock tick
+        server.reload_tls_certs()
+        self.assertEqual(await served_cert(), renewed, "keeps last good one")
+
+
+class TestRun(unittest.TestCase):
+    def test_sighup_ignored_early(self) -> None:
+        self.addCleanup(signal.signal, signal.SIGHUP, signal.getsignal(signal.SIGHUP))
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        with self.assertRaises(FileNotFoundError):
+            server.run(Path("/nonexistent/config.json"))
+        self.assertEqual(signal.getsignal(signal.SIGHUP), signal.SIG_IGN)
+
+
+class TestReload(unittest.IsolatedAsyncioTestCase):
+    async def test_reload(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.server.")
+        self.addCleanup(td.cleanup)
+        config_path = Path(td.name) / "config.json"
+        pop1 = {
+            "server_type": "pop",
+            "host": "127.0.0.1",
+            "port": 7985,
+            "tls": "disable",
+        }
+        pop2 = dict(pop1, port=7986)
+        config_path.write_text(json.dumps(make_cfg(td.name, "user1", [pop1])))
+        cfg = config.Config(config_path.read_text())
+        task = asyncio.create_task(server.a_main(cfg, config_path=config_path))
+        self.addCleanup(task.cancel)
+
+        async def wait_until(cond) -> None:
+            for _ in range(500):
+                if await cond():
+                    return
+                await asyncio.sleep(0.01)
+            self.fail("timed out")
+
+        async def listening() -> bool:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", 7985)
+            except ConnectionRefusedError:
+                return False
+            writer.close()
+            return True
+
+        async def reload(servers: list[dict], username: str) -> None:
+            config_path.write_text(json.dumps(make_cfg(td.name, username, servers)))
+            with self.assertLogs(level="INFO") as cm:
+                os.kill(os.getpid(), signal.SIGHUP)
+
+                async def reloaded() -> bool:
+                    return any(r.msg.startswith("Reloaded") for r in cm.records)
+
+                await wait_until(reloaded)
+
+        await wait_until(listening)
+
+        def login(port: int, username: str) -> bytes:
+            client = poplib.POP3("127.0.0.1", port)
+            client.user(username)
+            try:
+                return client.pass_("password")
+            except poplib.error_proto as e:
+                return e.args[0]
+            finally:
+                client.quit()
+
+        self.assertTrue(
+            (await asyncio.to_thread(login, 7985, "user1")).startswith(b"+OK")
+        )
+
+        await reload([pop1, pop2], "user2")
+        self.assertTrue(
+            (await asyncio.to_thread(login, 7985, "user2")).startswith(b"+OK")
+        )
+        self.assertTrue(
+            (await asyncio.to_thread(login, 7986, "user2")).startswith(b"+OK")
+        )
+        self.assertTrue(
+            (await asyncio.to_thread(login, 7985, "user1")).startswith(b"-ERR")
+        )
+
+        # Changed listener on the same port is replaced
+        await reload([dict(pop1, timeout_seconds=30)], "user2")
+        self.assertTrue(
+            (await asyncio.to_thread(login, 7985, "user2")).startswith(b"+OK")
+        )
+
+        await reload([pop2], "user2")
+        with self.assertRaises(ConnectionRefusedError):
+            await asyncio.to_thread(login, 7985, "user2")
+
+    async def test_unknown_server(self) -> None:
+        cfg = config.Config(make_cfg("/tmp", "user1", [{"server_type": "pops"}]))
+        with self.assertLogs(level="ERROR") as cm:
+            await server.a_main(cfg)
+        self.assertIn("Unknown server", cm.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
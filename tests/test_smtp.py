@@ -5,12 +5,15 @@ import smtplib
 import tempfile
 import contextlib
 import os
+import threading
 
 from pathlib import Path
 
-from mail4one.smtp import create_smtp_server
+from mail4one.maildir import Maildirs
+from mail4one.smtp import DeliveryQueue, create_smtp_server
 
 TEST_MBOX = "foobar_mails"
+TEST_MBOX_RAW = "foobar_raw_mails"
 MAILS_PATH: Path
 
 
@@ -71,10 +74,73 @@ class TestSMTP(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(len(mails), 1)
         self.assertEqual(mails[0].read_bytes(), expected.encode())
 
+    async def test_send_mail_raw(self) -> None:
+        smtp_server = await create_smtp_server(
+            host="127.0.0.1",
+            port=7997,
+            mails_path=MAILS_PATH,
+            mbox_finder=lambda addr: [TEST_MBOX_RAW],
+            ssl_context=None,
+            smtputf8=True,
+            raw_delivery=True,
+        )
+        await smtp_server.start_serving()
+        task = asyncio.create_task(smtp_server.serve_forever())
+        self.addCleanup(task.cancel)
+        msg = b"From: foo@sender.com\r\nTo: foo@bar.com\r\n\r\n.Hello\r\n"
+
+        def send_mail():
+            with contextlib.closing(
+                smtplib.SMTP(host="127.0.0.1", port=7997)
+            ) as client:
+                client.sendmail("foo@sender.com", "foo@bar.com", msg)
+                _, local_port = client.sock.getsockname()
+                return local_port
+
+        local_port = await asyncio.to_thread(send_mail)
+        expected = (
+            f"X-Peer: ('127.0.0.1', {local_port})\r\n"
+            "X-MailFrom: foo@sender.com\r\n"
+            "X-RcptTo: foo@bar.com\r\n"
+            "X-SSL: Type: plain, STARTTLS: False\r\n"
+        ).encode() + msg
+        mails = list((MAILS_PATH / TEST_MBOX_RAW / "new").glob("*"))
+        self.assertEqual(len(mails), 1)
+        self.assertEqual(mails[0].read_bytes(), expected)
+
     async def asyncTearDown(self) -> None:
         logging.debug("at teardown")
         self.task.cancel("test done")
 
 
+class TestDeliveryQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def test_wait_when_full(self) -> None:
+        td = tempfile.TemporaryDirectory(prefix="m41.smtp.")
+        self.addCleanup(td.cleanup)
+        queue = DeliveryQueue(Maildirs(Path(td.name)), workers=1, queue_size=0)
+        started, released = threading.Event(), threading.Event()
+        self.addCleanup(released.set)
+
+        def blocking_write(fp) -> None:
+            started.set()
+            released.wait(5)
+            fp.write(b"first\r\n")
+
+        first = asyncio.create_task(queue.deliver(["mbox"], blocking_write))
+        self.assertTrue(await asyncio.to_thread(started.wait, 5))
+        second = asyncio.create_task(
+            queue.deliver(["mbox"], lambda fp: fp.write(b"second\r\n"))
+        )
+        await asyncio.sleep(0.01)
+        self.assertFalse(second.done(), "waits for a slot")
+        self.assertEqual((queue.pending, queue.peak_pending), (2, 2))
+        released.set()
+        filenames = await asyncio.gather(first, second)
+        self.assertEqual(queue.pending, 0)
+        new_path = Path(td.name) / "mbox" / "new"
+        self.assertEqual(sorted(os.listdir(new_path)), sorted(filenames))
+
+
 if __name__ == "__main__":
     unittest.main()